@@ -0,0 +1,273 @@
+# coding: utf-8
+import argparse
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from freetype import Face
+
+from btxt import BinaryText, BinaryTextEntry
+from font import build_collection, rasterize_chars
+from pkg import Package, PackageEntry
+from utils import load_json, read_messages, save_json
+
+# First bytes of the synthetic entries, one of each alignment class and a 'bin' one
+ENTRY_KINDS = [b'MTXT', b'\x1bLua', b'MSAD', b'CWAV', b'BTXT', b'MMDL', b'\xff\xfe\x00\x01']
+FONT_DIRS = ['/usr/share/fonts', '/usr/local/share/fonts', '~/.local/share/fonts', '~/.fonts',
+             '/Library/Fonts', '/System/Library/Fonts', 'C:\\Windows\\Fonts']
+CJK_START = 0x4E00
+
+
+def make_package(path, count, max_size, seed=0):
+    r = random.Random(seed)
+    pkg = Package()
+    for i in range(count):
+        e = PackageEntry()
+        e.Hash1, e.Hash2 = r.getrandbits(32), r.getrandbits(32)
+        e.Data = r.choice(ENTRY_KINDS) + r.randbytes(r.randint(0, max_size))
+        pkg.entries.append(e)
+    pkg.save(path)
+    return sum(e.Size for e in pkg.entries)
+
+
+def make_text(count, cjk, seed=0):
+    r = random.Random(seed)
+    alphabet = [chr(c) for c in range(0x20, 0x7F) if chr(c) != '|'] + [chr(CJK_START + i) for i in range(cjk)]
+    btxt = BinaryText()
+    for i in range(count):
+        words = [''.join(r.choice(alphabet) for _ in range(r.randint(1, 12))) for _ in range(r.randint(1, 8))]
+        btxt.entries.append(BinaryTextEntry('LABEL_%s_%05d' % (r.choice(['HUD', 'MSG', 'MENU']), i),
+                                            '|'.join(words)))
+    return btxt
+
+
+def find_font(chars):
+    # A font from the usual system directories, preferring one that covers every char
+    fallback = None
+    for root in FONT_DIRS:
+        root = os.path.expanduser(root)
+        for parent, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if not name.lower().endswith(('.ttf', '.otf', '.ttc')):
+                    continue
+                path = os.path.join(parent, name)
+                try:
+                    face = Face(path)
+                except Exception:
+                    continue
+                if all(face.get_char_index(ord(c)) for c in chars):
+                    return path
+                fallback = fallback or path
+    return fallback
+
+
+class Bench(object):
+    def __init__(self, work, repeat=3, stages=None):
+        self.work = work
+        self.repeat = repeat
+        self.stages = stages
+        self.results = {}
+
+    def path(self, name):
+        return os.path.join(self.work, name)
+
+    def wants(self, name):
+        return not self.stages or any(name.startswith(s) for s in self.stages)
+
+    def time(self, name, func, items=0, size=0, setup=None):
+        # Best of repeat runs, setup runs untimed before each of them
+        if not self.wants(name):
+            return None
+        runs = []
+        result = None
+        for i in range(self.repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            result = func()
+            runs.append(time.perf_counter() - start)
+        best = min(runs)
+        self.results[name] = {'seconds': best, 'runs': runs, 'items': items, 'bytes': size}
+        print('%-18s %9.4fs %10.1f items/s %8.2f MB/s' % (
+            name, best, items / max(best, 1e-9), size / 0x100000 / max(best, 1e-9)))
+        return result
+
+    def clean(self, path):
+        def setup():
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        return setup
+
+    def run_package(self, count, max_size):
+        src = self.path('bench.pkg')
+        size = make_package(src, count, max_size)
+
+        pkg = Package(src)
+        self.time('pkg.load', lambda: Package(src), count, size)
+        self.time('pkg.load_lazy', lambda: Package(src, lazy=True).close(), count, size)
+        self.time('pkg.save', lambda: pkg.save(self.path('save.pkg')), count, size)
+
+        extracted = self.path('extract')
+
+        def extract():
+            with Package(src, lazy=True) as p:
+                p.extract(extracted)
+        self.time('pkg.extract', extract, count, size, self.clean(extracted))
+        if not os.path.isdir(extracted):
+            extract()
+
+        def create():
+            p = Package()
+            p.create(extracted)
+            p.save(self.path('create.pkg'))
+        self.time('pkg.create', create, count, size)
+
+        # A translation pass: a few entries replaced, everything else copied from the original
+        overlay = self.path('overlay')
+        self.clean(overlay)()
+        os.makedirs(overlay)
+        for e in pkg.entries[::max(1, count // 16)]:
+            with open(os.path.join(overlay, e.filename), 'wb') as fs:
+                fs.write(e.Data[:4] + b'\x00' * 64)
+
+        def repack():
+            with Package(src, lazy=True) as p:
+                p.import_data(overlay)
+                p.save(self.path('repack.pkg'))
+        self.time('pkg.repack', repack, count, size)
+
+    def run_text(self, count, cjk):
+        binary, plain = self.path('bench.btxt'), self.path('bench.txt')
+        btxt = make_text(count, cjk)
+        btxt.save(binary)
+        btxt.export_text(plain)
+        size = os.path.getsize(binary)
+
+        self.time('btxt.load', lambda: BinaryText(binary), count, size)
+        self.time('btxt.save', lambda: btxt.save(self.path('save.btxt')), count, size)
+        self.time('btxt.export', lambda: btxt.export_text(self.path('export.txt')), count, size)
+        self.time('btxt.read_messages', lambda: list(read_messages(plain)), count, os.path.getsize(plain))
+        self.time('btxt.import', lambda: btxt.import_text(plain), count, os.path.getsize(plain))
+
+    def run_font(self, ttf, chars, sizes, texture_size, workers):
+        specs = [(size, '', ttf, False, 0) for size in sizes]
+        glyphs = len(chars) * len(sizes)
+
+        self.time('font.rasterize', lambda: [rasterize_chars(ttf, size + 4, chars) for size in sizes], glyphs)
+        mfnc = self.time('font.build', lambda: build_collection(
+            ttf, texture_size, specs, chars, workers=workers, max_pages=16), glyphs)
+        if mfnc is None:
+            mfnc = build_collection(ttf, texture_size, specs, chars, workers=workers, max_pages=16)
+        mfnc.max_pages = 16
+        pages = self.time('font.pack', mfnc.pack, glyphs)
+        if pages is None:
+            pages = mfnc.pack()
+        self.time('font.atlas', lambda: [mfnc.composite(p) for p in range(len(pages))],
+                  glyphs, len(pages) * texture_size[0] * texture_size[1] * 4)
+        out = self.path('font')
+        os.makedirs(out, exist_ok=True)
+        self.time('font.save', lambda: mfnc.save(os.path.join(out, 'bench.buct'), os.path.join(out, 'bench_{}.bfont'),
+                                                  os.path.join(out, 'bench.bctex')), glyphs)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(base, current, threshold, stages=None):
+    # Prints the change of every stage, returns the stages slower than threshold and the
+    # ones only one side has (e.g. font stages skipped for lack of a font)
+    failed = []
+    print('%-18s %10s %10s %8s' % ('stage', 'base', 'current', 'change'))
+    for name in sorted(set(base['results']) | set(current['results'])):
+        if stages and not any(name.startswith(s) for s in stages):
+            continue
+        if name not in base['results'] or name not in current['results']:
+            failed.append(name)
+            old, new = [r[name]['seconds'] if name in r else None for r in (base['results'], current['results'])]
+            print('%-18s %10s %10s  MISSING' % (name, '-' if old is None else '%.4fs' % old,
+                                                 '-' if new is None else '%.4fs' % new))
+            continue
+        old, new = base['results'][name]['seconds'], current['results'][name]['seconds']
+        change = new / max(old, 1e-9) - 1
+        mark = ''
+        if change > threshold:
+            failed.append(name)
+            mark = ' SLOWER'
+        elif change < -threshold:
+            mark = ' faster'
+        print('%-18s %9.4fs %9.4fs %+7.1f%%%s' % (name, old, new, change * 100, mark))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the package, binary text and font tools on synthetic data.")
+    parser.add_argument('-o', '--output', help='Write results to this json file.')
+    parser.add_argument('-c', '--compare', help='Compare with these results (a second file is compared '
+                        'with the first instead of running), slower or missing stages fail.', nargs='+')
+    parser.add_argument('-t', '--threshold', help='Relative slowdown reported as a regression.',
+                        type=float, default=0.1)
+    parser.add_argument('-s', '--stages', help='Only run stages starting with these names.', nargs='+')
+    parser.add_argument('-r', '--repeat', help='Runs per stage, the best one counts.', type=int, default=3)
+    parser.add_argument('-n', '--scale', help='Multiply the synthetic data sizes.', type=float, default=1.0)
+    parser.add_argument('-j', '--jobs', help='Set worker count for rasterizing.', type=int, default=None)
+    parser.add_argument('--ttf', help='Set font for the font stages, a system font is used by default.')
+    parser.add_argument('--work', help='Keep the synthetic data in this directory.')
+    options = parser.parse_args()
+
+    if options.compare and len(options.compare) > 1:
+        failed = compare(load_json(options.compare[0]), load_json(options.compare[1]), options.threshold,
+                         options.stages)
+        sys.exit(1 if failed else 0)
+
+    scale = options.scale
+    params = {
+        'package_entries': int(2000 * scale), 'entry_max_size': 0x4000,
+        'text_entries': int(20000 * scale), 'cjk_chars': int(3000 * scale),
+        'font_sizes': [20, 32], 'texture_size': [4096, 2048], 'repeat': options.repeat,
+    }
+    chars = [chr(c) for c in range(0x21, 0x7F)] + [chr(CJK_START + i) for i in range(params['cjk_chars'])]
+
+    work = options.work or tempfile.mkdtemp(prefix='bench_')
+    os.makedirs(work, exist_ok=True)
+    bench = Bench(work, options.repeat, options.stages)
+    try:
+        bench.run_package(params['package_entries'], params['entry_max_size'])
+        bench.run_text(params['text_entries'], params['cjk_chars'])
+
+        ttf = options.ttf or find_font(chars[-1:] + chars[:1])
+        if not ttf:
+            print('No font found, skipping font stages (use --ttf)')
+        elif any(bench.wants('font.' + s) for s in ('rasterize', 'build', 'pack', 'atlas', 'save')):
+            print('Font:', ttf)
+            params['ttf'] = ttf
+            bench.run_font(ttf, chars, params['font_sizes'], tuple(params['texture_size']), options.jobs)
+    finally:
+        if not options.work:
+            shutil.rmtree(work, ignore_errors=True)
+
+    results = {
+        'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+        'params': params, 'results': bench.results,
+    }
+    if options.output:
+        save_json(options.output, results)
+    if options.compare:
+        failed = compare(load_json(options.compare[0]), results, options.threshold, options.stages)
+        sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,14 @@
 # coding: utf-8
 import argparse
 import binascii
-import codecs
 import os
 import re
 import struct
+import sys
+import time
 from io import BytesIO
 
-from utils import mkdirs, read_messages, readstrzt
+from utils import BatchReport, find_strzt, mkdirs, read_messages, run_parallel
 
 
 class FileTypeError(Exception):
@@ -33,6 +34,19 @@ class BinaryTextEntry(object):
         return fmt.format(lbl=self.Label, txt=self.Text.replace('|', '\n'))
 
 
+class ImportResult(object):
+    def __init__(self):
+        self.updated = []
+        # Labels of the plain text that the binary text does not have
+        self.unknown = []
+        # Labels that occur more than once in the plain text, the last one wins
+        self.duplicates = []
+
+    def __repr__(self):
+        return 'updated: %d, unknown: %d, duplicates: %d' % (
+            len(self.updated), len(self.unknown), len(self.duplicates))
+
+
 class BinaryText(object):
     Magic = b'BTXT'
     Version = binascii.a2b_hex("01000A00")
@@ -49,9 +63,29 @@ Label: {lbl}
 
     def __init__(self, path=None):
         self.entries = []
+        self._index = None
         if path:
             self.load(path)
 
+    @property
+    def index(self):
+        if self._index is None:
+            self.reindex()
+        return self._index
+
+    def reindex(self):
+        # Call after changing self.entries directly
+        self._index = {}
+        for e in self.entries:
+            self._index.setdefault(e.Label, []).append(e)
+
+    def find(self, label):
+        return self.index.get(label, [])
+
+    def get(self, label, default=None):
+        entries = self.index.get(label)
+        return entries[0] if entries else default
+
     def export_text(self, path):
         result = []
         for e in self.entries:
@@ -64,37 +98,59 @@ Label: {lbl}
 
     def import_text(self, path):
         messages = read_messages(path)
+        result = ImportResult()
+        seen = set()
+
+        for lbl, txt in messages:
+            if lbl in seen:
+                result.duplicates.append(lbl)
+            else:
+                seen.add(lbl)
+
+            entries = self.index.get(lbl)
+            if not entries:
+                result.unknown.append(lbl)
+                continue
+            for e in entries:
+                e.Text = txt
+            result.updated.append(lbl)
 
-        for m in messages:
-            for i in range(len(self.entries)):
-                if self.entries[i].Label == m[0]:
-                    self.entries[i].Text = m[1]
+        return result
 
     def from_text(self, path):
         messages = read_messages(path)
         self.entries = []
+        self._index = None
 
         for m in messages:
             self.entries.append(BinaryTextEntry(m[0], m[1]))
 
     def load(self, path):
-        fs = open(path, 'rb')
-        lblrdr = codecs.getreader('ascii')(fs)
-        txtrdr = codecs.getreader('utf-16le')(fs)
+        with open(path, 'rb') as fs:
+            self.parse(fs.read())
 
-        mg = fs.read(4)
+    def parse(self, data):
+        mg = data[:4]
         if mg != self.Magic:
             raise FileTypeError("Except magic: %s, actual (hex): %s" % (
                 self.Magic, binascii.b2a_hex(mg)))
 
-        ver = fs.read(4)
+        ver = data[4:8]
         if ver != self.Version:
             raise FileVersionError("Supportted version: %s, input file version: %s" % (
                 self.verstr(), self.verstr(ver)))
 
-        while True:
-            lbl = readstrzt(lblrdr)
-            txt = readstrzt(txtrdr)
+        pos = 8
+        size = len(data)
+        self._index = None
+        while pos < size:
+            end = find_strzt(data, pos)
+            lbl = data[pos:end].decode('ascii')
+            pos = min(end + 1, size)
+
+            end = find_strzt(data, pos, 2)
+            txt = data[pos:pos + ((end - pos) & ~1)].decode('utf-16le')
+            pos = end + 2
 
             if not lbl and not txt:
                 break
@@ -102,8 +158,6 @@ Label: {lbl}
             entry = BinaryTextEntry(lbl, txt)
             self.entries.append(entry)
 
-        fs.close()
-
     def save(self, path):
         fs = open(path, 'wb')
         fs.write(self.Magic)
@@ -118,6 +172,43 @@ Label: {lbl}
         return '%d.%d.%d-%d' % struct.unpack_from('bbbb', bstr)
 
 
+def convert_file(src, dst, create=False):
+    start = time.perf_counter()
+    if os.path.isfile(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+        return None
+
+    mkdirs(os.path.dirname(dst))
+    btxt = BinaryText()
+    if create:
+        btxt.from_text(src)
+        btxt.save(dst)
+    else:
+        btxt.load(src)
+        btxt.export_text(dst)
+    return 1, os.path.getsize(src), time.perf_counter() - start
+
+
+def batch(src_dir, dst_dir, create=False, jobs=None):
+    tasks = []
+    for parent, dirnames, filenames in os.walk(src_dir):
+        for name in sorted(filenames):
+            if name.lower().endswith('.txt'):
+                src = os.path.join(parent, name)
+                tasks.append((src, os.path.join(dst_dir, os.path.relpath(src, src_dir)), create))
+
+    report = BatchReport(len(tasks), 'files')
+    for task, result, error in run_parallel(convert_file, tasks, jobs):
+        name = os.path.relpath(task[0], src_dir)
+        if error:
+            report.fail(name, error)
+        elif result is None:
+            report.skip(name)
+        else:
+            report.add(name, *result)
+    report.summary()
+    return not report.failed
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Binary text tool for Metroid: Samus Returns.\r\nCreate by LITTOMA, TeamPB, 2018.12")
@@ -126,13 +217,21 @@ def main():
                        action='store_true', default=False)
     group.add_argument('-c', '--create', help='Convert plain text to binary text.',
                        action='store_true', default=False)
-    parser.add_argument('-b', '--binary', help="Set binary text file.")
-    parser.add_argument('-p', '--plain', help='Set plain text file.')
+    parser.add_argument('-b', '--binary', help="Set binary text file (or directory).")
+    parser.add_argument('-p', '--plain', help='Set plain text file (or directory).')
     parser.add_argument('-m', '--mkdir', help='Make directory for output.',
                         action='store_true', default=False)
+    parser.add_argument('-j', '--jobs', help='Set worker count when converting directories.',
+                        type=int, default=None)
     options = parser.parse_args()
-
-    if options.export:
+    if not options.binary or not options.plain:
+        parser.error('Both -b/--binary and -p/--plain are required')
+
+    if options.export and os.path.isdir(options.binary):
+        sys.exit(0 if batch(options.binary, options.plain, False, options.jobs) else 1)
+    elif options.create and os.path.isdir(options.plain):
+        sys.exit(0 if batch(options.plain, options.binary, True, options.jobs) else 1)
+    elif options.export:
         if(options.mkdir):
             mkdirs(os.path.split(options.plain)[0])
         btxt = BinaryText(options.binary)
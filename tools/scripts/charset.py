@@ -0,0 +1,179 @@
+# coding: utf-8
+import argparse
+import os
+import re
+import sys
+import time
+
+from btxt import BinaryText
+from pkg import Package
+from utils import BatchReport, file_digest, load_json, mkdirs, run_parallel, save_json
+
+TEXT_EXTS = ('.txt', '.btxt')
+
+
+def text_chars(btxt, patterns):
+    # {'': chars of every entry, size: chars of the entries whose label matches patterns[size]}
+    compiled = [(size, re.compile(p)) for size, p in sorted(patterns.items())]
+    result = {size: set() for size in patterns}
+    result[''] = set()
+    for e in btxt.entries:
+        chars = set(e.Text)
+        result[''].update(chars)
+        for size, p in compiled:
+            if p.search(e.Label):
+                result[size].update(chars)
+    # Control chars are never drawn
+    return {k: ''.join(sorted(c for c in v if c >= ' ')) for k, v in result.items()}
+
+
+def parse_text(data):
+    btxt = BinaryText()
+    btxt.parse(data)
+    return btxt
+
+
+def scan_file(root, name, patterns, known=()):
+    # (content hash, {key: {group: chars}}, seconds) where key is '' for a loose text and the
+    # entry name for every text in a package. The result is None when the hash is in known.
+    start = time.perf_counter()
+    path = os.path.join(root, name)
+    digest = file_digest(path)
+    if digest in known:
+        return digest, None, time.perf_counter() - start
+
+    result = {}
+    if name.lower().endswith('.pkg'):
+        with Package(path, lazy=True) as pkg:
+            for e in pkg.entries:
+                if e.Size >= 4 and e.peek(4) == BinaryText.Magic:
+                    result[os.path.splitext(e.filename)[0]] = text_chars(parse_text(bytes(e.Data)), patterns)
+    else:
+        with open(path, 'rb') as fs:
+            data = fs.read()
+        if data[:4] == BinaryText.Magic:
+            result[''] = text_chars(parse_text(data), patterns)
+    return digest, result, time.perf_counter() - start
+
+
+def find_inputs(root):
+    result = []
+    for parent, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(TEXT_EXTS + ('.pkg',)):
+                result.append(os.path.relpath(os.path.join(parent, name), root))
+    return result
+
+
+def language(name, key):
+    # Loose texts are named after their language (us_english.txt), package texts after the entry
+    if key:
+        return os.path.join(os.path.splitext(name)[0], key)
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+def scan(root, patterns=None, jobs=None, cache_path=None):
+    # Returns {language: {group: set of chars}}, group '' holding every char of the language
+    patterns = patterns or {}
+    cache = load_json(cache_path, None) if cache_path else None
+    if not cache or cache.get('patterns') != patterns:
+        cache = {'patterns': patterns, 'files': {}, 'results': {}}
+
+    names = find_inputs(root)
+    files, tasks = {}, []
+    for name in names:
+        st = os.stat(os.path.join(root, name))
+        old = cache['files'].get(name)
+        if old and old[:2] == [st.st_size, st.st_mtime_ns] and old[2] in cache['results']:
+            files[name] = old
+        else:
+            files[name] = [st.st_size, st.st_mtime_ns, None]
+            tasks.append((root, name, patterns, frozenset(cache['results'])))
+
+    report = BatchReport(len(names), 'texts')
+    for name in names:
+        if files[name][2] is not None:
+            report.skip(name)
+    for task, result, error in run_parallel(scan_file, tasks, jobs):
+        name = task[1]
+        if error:
+            report.fail(name, error)
+            del files[name]
+            continue
+        digest, texts, seconds = result
+        files[name][2] = digest
+        if texts is None:
+            report.skip(name)
+        else:
+            cache['results'][digest] = texts
+            report.add(name, len(texts), files[name][0], seconds)
+    report.summary()
+
+    charsets = {}
+    for name in names:
+        if name not in files:
+            continue
+        for key, groups in cache['results'][files[name][2]].items():
+            charset = charsets.setdefault(language(name, key), {})
+            for group, chars in groups.items():
+                charset.setdefault(group, set()).update(chars)
+
+    if cache_path:
+        used = set(f[2] for f in files.values())
+        cache['files'] = files
+        cache['results'] = {k: v for k, v in cache['results'].items() if k in used}
+        save_json(cache_path, cache)
+    return charsets, not report.failed
+
+
+def charset_path(out_dir, lang, group):
+    return os.path.join(out_dir, '%s_%s.txt' % (lang, group) if group else lang + '.txt')
+
+
+def save_charsets(charsets, out_dir, union=False):
+    # One UTF-16 file per language (and per size), as font.py create reads them
+    if union:
+        merged = {}
+        for groups in charsets.values():
+            for group, chars in groups.items():
+                merged.setdefault(group, set()).update(chars)
+        charsets = dict(charsets, all=merged)
+
+    for lang, groups in sorted(charsets.items()):
+        for group, chars in sorted(groups.items()):
+            path = charset_path(out_dir, lang, group)
+            mkdirs(os.path.dirname(path))
+            with open(path, 'w', encoding='utf-16') as fs:
+                fs.write(''.join(sorted(chars)))
+            print('%s: %d chars' % (path, len(chars)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Collect the chars used by binary texts, for font.py charsets and filters.")
+    parser.add_argument('-d', '--dir', help='Set directory of binary texts, extracted packages or packages.',
+                        required=True)
+    parser.add_argument('-o', '--output', help='Set output directory.', required=True)
+    parser.add_argument('-p', '--pattern', help='Also write <lang>_<size>.txt with the chars of the labels '
+                        'matching REGEX, as SIZE=REGEX.', action='append', default=[])
+    parser.add_argument('-u', '--union', help='Also write all.txt with the chars of every language.',
+                        action='store_true', default=False)
+    parser.add_argument('-c', '--cache', help='Set cache file of per-file results.')
+    parser.add_argument('-j', '--jobs', help='Set worker count.', type=int, default=None)
+    options = parser.parse_args()
+
+    patterns = {}
+    for p in options.pattern:
+        size, sep, regex = p.partition('=')
+        if not sep:
+            parser.error('Bad pattern %s, expected SIZE=REGEX' % p)
+        patterns[size] = regex
+
+    charsets, ok = scan(options.dir, patterns, options.jobs, options.cache)
+    save_charsets(charsets, options.output, options.union)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,22 @@
+import copy
+import ctypes
+import math
 import struct
 import sys
 import os
+from collections import namedtuple
 from os import SEEK_SET
 from io import BytesIO
 
 import freetype
-import greedypacker
 from freetype import FT_LOAD_FLAGS, Face
 from PIL import Image
 
+from glyphcache import GlyphCache, MemoryGlyphCache
+from mfnt import BFONT_HEADER, CharTable, GlyphTable
+from packer import AtlasOverflowError, PackerItem, ShelfPacker
+from utils import data_digest, file_digest, load_json, run_parallel, save_json
+
 
 ICONS = {
     0x1800: (-1, 30, 34),
@@ -66,6 +74,27 @@ ICONS = {
 }
 
 
+LOAD_FLAGS = FT_LOAD_FLAGS['FT_LOAD_RENDER'] | FT_LOAD_FLAGS['FT_LOAD_NO_HINTING'] | FT_LOAD_FLAGS['FT_LOAD_NO_HINTING']
+
+# 8-bit coverage of a rendered char, rows packed without padding
+Raster = namedtuple('Raster', 'width rows data xoffset yoffset xadv')
+
+
+PNG_COMPRESS_LEVEL = 1
+
+ICONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'icons')
+ICON_BUNDLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'icons.bin')
+ICON_RECORD = struct.Struct('<HHHhhh')
+
+
+def page_path(path, page):
+    # Extra atlas pages go next to the first one as <name>_<page><ext>
+    if not page or not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return '%s_%d%s' % (root, page, ext)
+
+
 def f26d6_to_int(val):
     ret = (abs(val) & 0x7FFFFFC0) >> 6
     if val < 0:
@@ -74,11 +103,46 @@ def f26d6_to_int(val):
         return ret
 
 
+def rasterize(c, font: Face):
+    font.load_char(c, LOAD_FLAGS)
+
+    glyphslot = font.glyph
+    bitmap = glyphslot.bitmap
+    width, rows, pitch = bitmap.width, bitmap.rows, bitmap.pitch
+    data = b''
+    if width and rows:
+        # Bitmap.buffer builds a Python list, read the FT buffer directly instead
+        data = ctypes.string_at(bitmap._FT_Bitmap.buffer, rows * abs(pitch))
+        if pitch != width:
+            data = Image.frombuffer('L', (width, rows), data, 'raw', 'L',
+                                    abs(pitch), 1 if pitch > 0 else -1).tobytes()
+
+    return Raster(width, rows, data,
+                  f26d6_to_int(glyphslot.metrics.horiBearingX),
+                  f26d6_to_int(glyphslot.metrics.horiBearingY),
+                  f26d6_to_int(glyphslot.metrics.horiAdvance))
+
+
+_faces = {}
+
+
+def rasterize_chars(font_path, pixel_size, chars):
+    # Pool worker, keeps one Face per font file and size for the life of the process
+    face = _faces.get((font_path, pixel_size))
+    if face is None:
+        face = Face(font_path)
+        face.set_pixel_sizes(pixel_size, pixel_size)
+        _faces[(font_path, pixel_size)] = face
+    return [rasterize(c, face) for c in chars]
+
+
 class MetroidFontGlyph(object):
     def __init__(self) -> None:
         super().__init__()
         self.image = Image.new(mode='RGBA', size=(4, 4))
-        self.packer_item = greedypacker.Item(4, 4)
+        # Rasterized glyphs also keep their coverage, the L band their image is made of
+        self.coverage = None
+        self.packer_item = PackerItem(4, 4)
         self.xoffset = 0
         self.yoffset = 0
         self.xadv = 0
@@ -105,54 +169,118 @@ class MetroidFontGlyph(object):
 
     @staticmethod
     def new(c, font: Face):
-        mfg = MetroidFontGlyph()
-
-        flags = FT_LOAD_FLAGS['FT_LOAD_RENDER'] | FT_LOAD_FLAGS['FT_LOAD_NO_HINTING'] | FT_LOAD_FLAGS['FT_LOAD_NO_HINTING']
-        font.load_char(c, flags)
+        return MetroidFontGlyph.from_raster(rasterize(c, font))
 
-        glyphslot = font.glyph
-        bitmap = glyphslot.bitmap
-        adv = f26d6_to_int(glyphslot.metrics.horiAdvance)
-        horiBearingX = f26d6_to_int(glyphslot.metrics.horiBearingX)
-        horiBearingY = f26d6_to_int(glyphslot.metrics.horiBearingY)
-        gheight = f26d6_to_int(glyphslot.metrics.height)
+    @staticmethod
+    def from_raster(raster: Raster):
+        mfg = MetroidFontGlyph()
 
-        if bitmap.width == 0 or bitmap.rows == 0:
-            mfg.image = Image.new(mode='LA', size=(4, 4))
+        if raster.width == 0 or raster.rows == 0:
+            mfg.coverage = Image.new(mode='L', size=(4, 4))
         else:
-            pixel_data = struct.pack(
-                'B'*len(bitmap.buffer)*2, *(x for pix in ((a, a) for a in bitmap.buffer) for x in pix))
-            mfg.image = Image.frombuffer(mode='LA', size=(
-                bitmap.width, bitmap.rows), data=pixel_data)
+            mfg.coverage = Image.frombuffer('L', (raster.width, raster.rows), raster.data, 'raw', 'L', 0, 1)
+        mfg.image = Image.merge('LA', (mfg.coverage, mfg.coverage))
 
-        mfg.packer_item = greedypacker.Item(
-            mfg.image.width, mfg.image.height, rotation=False)
+        mfg.packer_item = PackerItem(mfg.image.width, mfg.image.height)
 
-        mfg.xoffset = horiBearingX
-        mfg.yoffset = horiBearingY
-        mfg.xadv = adv
+        mfg.xoffset = raster.xoffset
+        mfg.yoffset = raster.yoffset
+        mfg.xadv = raster.xadv
 
         return mfg
 
     @staticmethod
     def new_icon(icon_id):
         mfg = MetroidFontGlyph()
-        icon_path = os.path.join(os.path.dirname(
-            os.path.abspath(__file__)), 'icons', '%04x.png' % ord(icon_id))
+        icon_path = os.path.join(ICONS_DIR, '%04x.png' % ord(icon_id))
         if os.path.isfile(icon_path):
-            mfg.image = Image.open(icon_path)
-            mfg.packer_item = greedypacker.Item(
-                mfg.image.width, mfg.image.height, rotation=False)
-            mfg.xoffset = -1
-            mfg.yoffset = 30
-            mfg.xadv = 34
+            mfg.image = Image.open(icon_path).convert('RGBA')
+            mfg.packer_item = PackerItem(mfg.image.width, mfg.image.height)
+            mfg.xoffset, mfg.yoffset, mfg.xadv = ICONS[ord(icon_id)]
             return mfg
         else:
             raise FileNotFoundError(icon_path)
 
+    @staticmethod
+    def from_rgba(width, height, data, xoffset, yoffset, xadv):
+        mfg = MetroidFontGlyph()
+        mfg.image = Image.frombuffer('RGBA', (width, height), data, 'raw', 'RGBA', 0, 1)
+        mfg.packer_item = PackerItem(width, height)
+        mfg.xoffset, mfg.yoffset, mfg.xadv = xoffset, yoffset, xadv
+        return mfg
+
+
+def compile_icons(path=None):
+    # Bundle every icon as (code, size, metrics) + RGBA pixels so runs read a single file
+    path = path or ICON_BUNDLE
+    # Builds running in parallel may all find the bundle stale, each writes its own file
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as fs:
+        fs.write(struct.pack('<4sI', b'MICN', len(ICONS)))
+        for i in sorted(ICONS.keys()):
+            icon = MetroidFontGlyph.new_icon(chr(i))
+            fs.write(ICON_RECORD.pack(i, icon.image.width, icon.image.height,
+                                      icon.xoffset, icon.yoffset, icon.xadv))
+            fs.write(icon.image.tobytes())
+    os.replace(tmp, path)
+
+
+def icon_bundle_stale(path):
+    if not os.path.isfile(path):
+        return True
+    built = os.path.getmtime(path)
+    sources = [os.path.abspath(__file__)] + [
+        os.path.join(ICONS_DIR, '%04x.png' % i) for i in ICONS]
+    return any(os.path.getmtime(p) > built for p in sources)
+
+
+_icons = None
+
+
+def load_icons():
+    # Icons are decoded once per process and shared by every collection and font
+    global _icons
+    if _icons is not None:
+        return _icons
+
+    if not icon_bundle_stale(ICON_BUNDLE):
+        try:
+            _icons = read_icon_bundle(ICON_BUNDLE)
+            return _icons
+        except (ValueError, struct.error):
+            # A bad bundle is built again like a stale one
+            pass
+
+    try:
+        compile_icons(ICON_BUNDLE)
+        _icons = read_icon_bundle(ICON_BUNDLE)
+    except (OSError, ValueError, struct.error):
+        _icons = {chr(i): MetroidFontGlyph.new_icon(chr(i)) for i in ICONS}
+    return _icons
+
+
+def read_icon_bundle(path):
+    with open(path, 'rb') as fs:
+        data = memoryview(fs.read())
+    magic, count = struct.unpack_from('<4sI', data)
+    if magic != b'MICN':
+        raise ValueError("Bad icon bundle: %s" % path)
+    pos = 8
+    icons = {}
+    for _ in range(count):
+        code, width, height, xoffset, yoffset, xadv = ICON_RECORD.unpack_from(data, pos)
+        pos += ICON_RECORD.size
+        size = width * height * 4
+        if pos + size > len(data):
+            raise ValueError("Truncated icon bundle: %s" % path)
+        icons[chr(code)] = MetroidFontGlyph.from_rgba(
+            width, height, data[pos:pos + size], xoffset, yoffset, xadv)
+        pos += size
+    return icons
+
 
 class MetroidFont(object):
-    HEADER_STRUCTURE = '4sBBBBqiihhiiiqq'
+    HEADER_STRUCTURE = BFONT_HEADER
 
     def __init__(self) -> None:
         super().__init__()
@@ -167,16 +295,32 @@ class MetroidFont(object):
         self.glyph_data_offset = 0
         self.glyph_table_path = 0
         self.glyphs = {}
+        self.page = 0
+
+        # Set when loaded from an existing bfont, so an unchanged font saves byte-identically
+        self.records = None
+        self.texture_name = None
+        self.glyph_table_name = None
+        self.header_gap = b''
+        self.path_padding = None
+        self.records_gap = b''
+        self.tail = b''
 
         self.font_face = None
+        self.font_path = None
         self.__filter__ = ''
+        self.__filter_set__ = set()
 
     def init_fontface(self, path):
+        self.font_path = path
         self.font_face = Face(path)
         self.font_face.set_pixel_sizes(self.font_size, self.font_size)
 
+    def wants(self, c):
+        return not self.__filter__ or c in self.__filter_set__
+
     def add_char(self, c):
-        if (not self.__filter__ or c in self.__filter__):
+        if self.wants(c):
             glyph = MetroidFontGlyph.new(c, self.font_face)
         else:
             glyph = MetroidFontGlyph.empty()
@@ -191,6 +335,7 @@ class MetroidFont(object):
     @filter.setter
     def filter(self, value: str):
         self.__filter__ = sorted(value)
+        self.__filter_set__ = set(value)
 
     @property
     def texture_width(self):
@@ -209,16 +354,45 @@ class MetroidFont(object):
         self.texture_size[1] = value
 
     @staticmethod
-    def new(font_size, font_path, texture_size, chars_filter):
+    def new(font_size, font_path, texture_size, chars_filter, pixel_size=None):
         mfnt = MetroidFont()
 
-        mfnt.font_size = font_size+4
+        mfnt.font_size = pixel_size or font_size+4
         mfnt.texture_size = texture_size
         mfnt.filter = chars_filter
         mfnt.init_fontface(font_path)
 
         return mfnt
 
+    @staticmethod
+    def load(path):
+        # Header, paths and glyph records only, MetroidFontCollection.load makes the glyphs
+        with open(path, 'rb') as fs:
+            data = fs.read()
+
+        mfnt = MetroidFont()
+        header_size = struct.calcsize('<' + MetroidFont.HEADER_STRUCTURE)
+        (mfnt.magic, v0, v1, v2, v3, mfnt.texture_path_offset, width, height,
+         mfnt.unk1, mfnt.unk2, mfnt.font_size, mfnt.glyph_count, mfnt.unk3,
+         mfnt.glyph_data_offset, mfnt.glyph_table_path) = struct.unpack_from(
+            '<' + MetroidFont.HEADER_STRUCTURE, data)
+        mfnt.version = (v0, v1, v2, v3)
+        mfnt.texture_size = (width, height)
+
+        end = data.index(b'\x00', mfnt.texture_path_offset)
+        mfnt.header_gap = data[header_size:mfnt.texture_path_offset]
+        mfnt.texture_name = data[mfnt.texture_path_offset:end].decode('utf-8')
+        mfnt.path_padding = data[end + 1:mfnt.glyph_data_offset]
+
+        end = mfnt.glyph_data_offset + mfnt.glyph_count * 0x0E
+        mfnt.records = GlyphTable(data[mfnt.glyph_data_offset:end])
+        mfnt.records_gap = data[end:mfnt.glyph_table_path]
+
+        end = data.index(b'\x00', mfnt.glyph_table_path)
+        mfnt.glyph_table_name = data[mfnt.glyph_table_path:end].decode('utf-8')
+        mfnt.tail = data[end + 1:]
+        return mfnt
+
 
 class MetroidFontCollection(object):
     def __init__(self) -> None:
@@ -226,56 +400,198 @@ class MetroidFontCollection(object):
 
         self.fonts = {}
         self.chars = []
+        self.__char_set__ = set()
         self.icons = {}
 
         self.texture_size = (0, 0)
         self.font_path = ''
+        self.max_pages = 1
+        self.pages = []
+
+        # Set by load: the glyph id of every char in the existing glyph table, its raw
+        # header and records, and the atlas pages new glyphs are drawn over
+        self.char_ids = None
+        self.table_head = b''
+        self.table_records = b''
+        self.atlases = []
 
     def add_char(self, c):
-        if c in self.chars:
+        if c in self.__char_set__:
             return
 
         self.chars.append(c)
+        self.__char_set__.add(c)
         for k in self.fonts.keys():
             font = self.fonts[k]
             font.add_char(c)
 
-    def add_font(self, size, filter, font_path=None, use_icon=False):
+    def add_chars(self, chars, workers=None, chunk_size=256, cache=None):
+        # Rasterize on a process pool, one task per font and chunk of chars.
+        # Glyphs found in cache (a GlyphCache) are not rendered again.
+        chars = [c for c in sorted(set(chars)) if c not in self.__char_set__]
+        rasters = {}
+        tasks = []
+        for font in self.fonts.values():
+            key = (font.font_path, font.font_size)
+            if key in rasters:
+                continue
+            rasters[key] = {}
+            wanted = [c for c in chars if any(
+                f.wants(c) for f in self.fonts.values() if (f.font_path, f.font_size) == key)]
+            if cache:
+                cached = cache.get(font.font_path, font.font_size, LOAD_FLAGS, wanted)
+                rasters[key].update((c, Raster(*r)) for c, r in cached.items())
+                wanted = [c for c in wanted if c not in cached]
+            for i in range(0, len(wanted), chunk_size):
+                tasks.append((font.font_path, font.font_size, wanted[i:i + chunk_size]))
+
+        done, total = 0, sum(len(t[2]) for t in tasks)
+        for task, result, error in run_parallel(rasterize_chars, tasks, workers):
+            if error:
+                raise error
+            rasters[task[:2]].update(zip(task[2], result))
+            if cache:
+                cache.put(task[0], task[1], LOAD_FLAGS, dict(zip(task[2], result)))
+            done += len(result)
+            sys.stdout.write("Rasterizing chars...(%d/%d)\r" % (done, total))
+        print('')
+
+        for c in chars:
+            self.chars.append(c)
+            self.__char_set__.add(c)
+            for font in self.fonts.values():
+                if font.wants(c):
+                    font.glyphs[c] = MetroidFontGlyph.from_raster(rasters[(font.font_path, font.font_size)][c])
+                else:
+                    font.glyphs[c] = MetroidFontGlyph.empty()
+                font.glyph_count = len(font.glyphs)
+
+    def add_font(self, size, filter, font_path=None, use_icon=False, pixel_size=None):
         if not font_path:
             font_path = self.font_path
         mfnt = MetroidFont.new(
-            size, font_path, self.texture_size, filter)
+            size, font_path, self.texture_size, filter, pixel_size)
         self.fonts[size] = mfnt
         if use_icon:
             print('Use icon')
             for k in self.icons:
-                mfnt.glyphs[k] = self.icons[k]
+                # Own copy per font, fonts may end up on different pages
+                icon = copy.copy(self.icons[k])
+                icon.packer_item = PackerItem(icon.image.width, icon.image.height)
+                mfnt.glyphs[k] = icon
+
+    def set_sources(self, specs):
+        # TTF and filter of loaded fonts, for the chars added to them
+        for size, filter, font_path, use_icon, priority in specs:
+            font = self.fonts[size]
+            font.font_path = font_path or self.font_path
+            font.filter = filter
+
+    def pack_fonts(self, fonts):
+        # Identical bitmaps (empty glyphs, icons shared by several sizes) share one rect
+        unique = {}
+        for font in fonts:
+            for glyph in font.glyphs.values():
+                key = (glyph.image.mode, glyph.image.size, glyph.image.tobytes())
+                if key not in unique:
+                    unique[key] = PackerItem(glyph.image.width, glyph.image.height)
+                glyph.packer_item = unique[key]
+
+        return ShelfPacker.pack(unique.values(), self.texture_size[0], self.texture_size[1])
+
+    def pack(self):
+        # A bfont references a single texture, so every font lives on one page
+        pages = []
+        for font in self.fonts.values():
+            for page in pages:
+                if len(self.pack_fonts(page + [font])) == 1:
+                    page.append(font)
+                    break
+            else:
+                pages.append([font])
+
+        self.pages = []
+        for i, page in enumerate(pages):
+            bins = self.pack_fonts(page)
+            if len(bins) > 1:
+                size = next(k for k, f in self.fonts.items() if f is page[0])
+                raise AtlasOverflowError("Font size %s (%dpx) alone does not fit the texture" % (
+                    size, page[0].font_size))
+            for font in page:
+                font.page = i
+            self.pages.append(bins[0])
+        return self.pages
+
+    def pack_new(self):
+        # Loaded glyphs keep their rects, the ones added since go below the content of their page
+        self.pages = []
+        for page in range(len(self.atlases)):
+            fonts = [f for f in self.fonts.values() if f.page == page]
+            bottom = max((g.packed_bottom for f in fonts for c, g in f.glyphs.items() if c in self.char_ids),
+                         default=0)
+            unique = {}
+            for font in fonts:
+                for c, glyph in font.glyphs.items():
+                    if c in self.char_ids:
+                        continue
+                    key = (glyph.image.mode, glyph.image.size, glyph.image.tobytes())
+                    if key not in unique:
+                        unique[key] = PackerItem(glyph.image.width, glyph.image.height)
+                    glyph.packer_item = unique[key]
+
+            height = self.texture_size[1] - bottom
+            if unique and (height <= 0 or len(ShelfPacker.pack(unique.values(), self.texture_size[0], height)) > 1):
+                raise AtlasOverflowError("No free atlas space on page %d" % page)
+            bins = ShelfPacker.pack(unique.values(), self.texture_size[0], max(height, 1))
+            for item in unique.values():
+                item.y += bottom
+            print('Atlas page %d: %d new glyphs below y=%d' % (page, len(unique), bottom))
+            self.pages.append(bins[0])
+        return self.pages
+
+    def char_order(self):
+        # Chars by glyph id, ids missing from a loaded table are None
+        if self.char_ids is None:
+            return sorted(self.chars) + sorted(self.icons.keys())
+        order = [None] * (max(self.char_ids.values(), default=-1) + 1)
+        for c, i in self.char_ids.items():
+            order[i] = c
+        order.extend(c for c in sorted(self.chars) if c not in self.char_ids)
+        return order
 
     def remap(self):
         print('Remapping...')
-        glyphs = (glyph for glyphs in (font.glyphs.values()
-                  for font in self.fonts.values()) for glyph in glyphs)
-        bin_man = greedypacker.BinManager(
-            self.texture_size[0], self.texture_size[1], pack_algo='skyline', heuristic='bottom_left', rotation=False)
-        bin_man.add_items(*(glyph.packer_item for glyph in glyphs))
-        bin_man.execute()
-
-        if len(bin_man.bins) > 1:
+        if self.char_ids is not None:
+            self.pack_new()
+            return
+        pages = self.pack()
+        for i, page in enumerate(pages):
+            print('Atlas page %d fill: %.1f%% (%d unique glyphs)' % (i, page.fill * 100, len(page.items)))
+
+        if len(pages) > self.max_pages:
             raise ValueError(
-                "Too many chars, try to trim the font size using filters")
+                "Too many chars (%d pages), try to trim the font size using filters" % len(pages))
 
     def save(self, glyph_table_path: str, bfont_path_format: str, texture_path: str,
              glyph_table_path_in_game: str = None, texture_path_in_game: str = None):
-        chars = sorted(self.chars)
-        chars.extend(sorted(self.icons.keys()))
+        chars = self.char_order()
         self.remap()
 
         # Save glyph table
         with open(glyph_table_path, 'wb') as buct:
-            # Write header
-            buct.write(struct.pack('<4sbbbbiiq', b'MUCT', *(1, 0, 4, 0),
-                       len(chars), -1, 0x18))
-            for i in range(len(chars)):
+            start = 0
+            if self.char_ids is None:
+                # Write header
+                buct.write(struct.pack('<4sbbbbiiq', b'MUCT', *(1, 0, 4, 0),
+                           len(chars), -1, 0x18))
+            else:
+                # Loaded records are kept as they are, new chars get the next ids
+                new = len(self.chars) - len(self.char_ids)
+                start = len(chars) - new
+                buct.write(self.table_head[:8] + struct.pack('<i', len(self.char_ids) + new) +
+                           self.table_head[12:])
+                buct.write(self.table_records)
+            for i in range(start, len(chars)):
                 buct.write(struct.pack('<Hhi', ord(chars[i]), -1, i))
 
         # Save bfonts
@@ -290,29 +606,51 @@ class MetroidFontCollection(object):
                     font.unk1, font.unk2, font.font_size, font.glyph_count, font.unk3,
                     font.glyph_data_offset, font.glyph_table_path))
 
+                bfont.write(font.header_gap)
                 font.texture_path_offset = bfont.tell()
                 if texture_path_in_game:
-                    bfont.write(texture_path_in_game.encode('utf-8'))
+                    name = page_path(texture_path_in_game, font.page)
+                elif font.texture_name is not None:
+                    name = font.texture_name
                 else:
-                    bfont.write(texture_path.encode('utf-8'))
+                    name = page_path(texture_path, font.page)
+                bfont.write(name.encode('utf-8'))
                 bfont.write(b'\x00')
+                if font.path_padding is not None and name == font.texture_name:
+                    bfont.write(font.path_padding)
                 # align?
                 while bfont.tell() % 0x10 != 0:
                     bfont.write(b'\xFF')
                 font.glyph_data_offset = bfont.tell()
 
-                for c in chars:
+                # Loaded fonts start from their records, ids with no glyph keep theirs
+                table = GlyphTable() if font.records is None else GlyphTable(font.records.tobytes())
+                for i, c in enumerate(chars):
                     if c not in font.glyphs:
-                        break  # Should break
+                        if font.records is None:
+                            break  # Should break
+                        continue
                     glyph: MetroidFontGlyph = font.glyphs[c]
-                    bfont.write(struct.pack('<hhhhhhh', glyph.packer_item.x, glyph.packer_item.y,
-                                glyph.packer_item.width, glyph.packer_item.height, glyph.xoffset, glyph.yoffset, glyph.xadv))
+                    record = (glyph.packer_item.x, glyph.packer_item.y,
+                              glyph.packer_item.width, glyph.packer_item.height, glyph.xoffset, glyph.yoffset, glyph.xadv)
+                    if i < len(table):
+                        table.set(i, *record)
+                    else:
+                        table.pad(i - len(table))
+                        table.append(*record)
+                if font.records is not None:
+                    font.glyph_count = len(table)
+                bfont.write(table.tobytes())
+                bfont.write(font.records_gap)
                 font.glyph_table_path = bfont.tell()
                 if glyph_table_path_in_game:
                     bfont.write(glyph_table_path_in_game.encode('utf-8'))
+                elif font.glyph_table_name is not None:
+                    bfont.write(font.glyph_table_name.encode('utf-8'))
                 else:
                     bfont.write(glyph_table_path.encode('utf-8'))
                 bfont.write(b'\x00')
+                bfont.write(font.tail)
 
                 bfont.seek(0, SEEK_SET)
                 # Write updated header
@@ -322,15 +660,43 @@ class MetroidFontCollection(object):
                     font.unk1, font.unk2, font.font_size, font.glyph_count, font.unk3,
                     font.glyph_data_offset, font.glyph_table_path))
 
-        # Save texture
-        glyphs = (glyph for glyphs in (font.glyphs.values()
-                  for font in self.fonts.values()) for glyph in glyphs)
-        tex = Image.new(mode='RGBA', size=self.texture_size)
-        for glyph in glyphs:
-            tex.paste(glyph.image, (glyph.packed_left, glyph.packed_top,
-                      glyph.packed_right, glyph.packed_bottom))
-        # Save as png first
-        tex.save(texture_path.replace('.bctex', '.png'))
+        # Save textures
+        for page in range(len(self.pages)):
+            tex = self.composite(page)
+            # Save as png first
+            tex.save(page_path(texture_path, page).replace('.bctex', '.png'),
+                     compress_level=PNG_COMPRESS_LEVEL)
+
+    def composite(self, page=0):
+        # Rasterized glyphs are pasted once per packed rect into an L band that becomes all
+        # four channels in one merge, icons and loaded glyphs are pasted over it as RGBA
+        band = Image.new('L', self.texture_size)
+        mask = Image.new('L', self.texture_size) if page < len(self.atlases) else None
+        others = []
+        done = set()
+        for font in self.fonts.values():
+            if font.page != page:
+                continue
+            for glyph in font.glyphs.values():
+                item = glyph.packer_item
+                if id(item) in done:
+                    continue
+                done.add(id(item))
+
+                if glyph.coverage is None:
+                    others.append(glyph)
+                    continue
+                band.paste(glyph.coverage, (item.x, item.y))
+                if mask:
+                    mask.paste(255, (item.x, item.y, item.x + item.width, item.y + item.height))
+
+        tex = Image.merge('RGBA', (band, band, band, band))
+        if mask:
+            # Keep the loaded atlas outside the rects of the new glyphs
+            tex = Image.composite(tex, self.atlases[page].convert('RGBA'), mask)
+        for glyph in others:
+            tex.paste(glyph.image.convert('RGBA'), (glyph.packer_item.x, glyph.packer_item.y))
+        return tex
 
     @staticmethod
     def new(font_path, texture_size):
@@ -338,47 +704,279 @@ class MetroidFontCollection(object):
         mfc.font_path = font_path
         mfc.texture_size = texture_size
 
-        # Load icons
-        for i in ICONS.keys():
-            c = chr(i)
-            icon = MetroidFontGlyph.new_icon(c)
-            icon.xoffset = ICONS[i][0]
-            icon.yoffset = ICONS[i][1]
-            icon.xadv = ICONS[i][2]
+        mfc.icons = dict(load_icons())
 
-            mfc.icons[c] = icon
+        return mfc
 
+    @staticmethod
+    def load(glyph_table_path, bfont_path_format, sizes, texture_path, font_path=None):
+        # Opens fonts saved by save() (or the game's): texture_path names the atlas as it
+        # was given to save. Chars added later are rasterized from font_path at the
+        # pixel size of each font and packed into the free space of the atlas.
+        mfc = MetroidFontCollection()
+        mfc.font_path = font_path
+
+        table = CharTable(glyph_table_path)
+        mfc.chars = [chr(c) for c in table.codes]
+        mfc.__char_set__ = set(mfc.chars)
+        mfc.char_ids = dict(zip(mfc.chars, table.ids))
+        mfc.table_head, mfc.table_records = table.head, table.data
+
+        for size in sizes:
+            font = MetroidFont.load(bfont_path_format.format(size))
+            font.font_path = font_path
+            mfc.fonts[size] = font
+            mfc.texture_size = font.texture_size
+
+        # Pages saved by save() are <name>, <name>_1..., whatever order the sizes come in
+        names = []
+        for font in mfc.fonts.values():
+            if font.texture_name not in names:
+                names.append(font.texture_name)
+        for name in names:
+            paged = [page_path(name, i) for i in range(len(names))]
+            if set(paged) == set(names):
+                names = paged
+                break
+        for font in mfc.fonts.values():
+            font.page = names.index(font.texture_name)
+
+        for page in range(len(names)):
+            png = page_path(texture_path, page).replace('.bctex', '.png')
+            mfc.atlases.append(Image.open(png).convert('RGBA'))
+
+        # Glyphs sharing a rect share its PackerItem, like packed ones do
+        items = {}
+        for font in mfc.fonts.values():
+            atlas = mfc.atlases[font.page]
+            for c in mfc.chars:
+                i = mfc.char_ids[c]
+                if i >= len(font.records):
+                    continue
+                e = font.records[i]
+                key = (font.page,) + e.rect
+                if key not in items:
+                    items[key] = PackerItem(e.width, e.height)
+                    items[key].x, items[key].y = e.x, e.y
+                glyph = MetroidFontGlyph()
+                glyph.image = atlas.crop(e.box)
+                glyph.packer_item = items[key]
+                glyph.xoffset, glyph.yoffset, glyph.xadv = e.attr1, e.attr2, e.attr3
+                font.glyphs[c] = glyph
         return mfc
 
 
+def build_collection(ttf_path, texture_size, specs, charset, pixel_sizes=None, workers=None, cache=None,
+                     max_pages=1):
+    mfnc = MetroidFontCollection.new(ttf_path, texture_size)
+    mfnc.max_pages = max_pages
+    for size, filter, font_path, use_icon, priority in specs:
+        mfnc.add_font(size, filter, font_path, use_icon, (pixel_sizes or {}).get(size))
+    mfnc.add_chars(charset, workers, cache=cache)
+    return mfnc
+
+
+def fit_collection(ttf_path, texture_size, specs, charset, min_scale=0.5, workers=None, cache=None,
+                   max_pages=1):
+    # Shrink the lowest priority fonts first: binary search the largest pixel size
+    # that fits, and only move on to the next font if even min_scale overflows
+    cache = MemoryGlyphCache(cache)
+    pixel_sizes = {spec[0]: spec[0] + 4 for spec in specs}
+
+    def trial():
+        print('Trying pixel sizes: %s' % ', '.join('%d: %d' % i for i in pixel_sizes.items()))
+        mfnc = build_collection(ttf_path, texture_size, specs, charset, pixel_sizes, workers, cache,
+                                max_pages)
+        try:
+            return mfnc if len(mfnc.pack()) <= max_pages else None
+        except AtlasOverflowError:
+            # A single font (or glyph) larger than a page does not fit either
+            return None
+
+    best = trial()
+    for size, filter, font_path, use_icon, priority in sorted(specs, key=lambda s: s[4]):
+        if best:
+            break
+        hi = pixel_sizes[size]
+        lo = max(1, int(math.ceil(hi * min_scale)))
+        pixel_sizes[size] = lo
+        best = trial()
+        if not best:
+            continue
+        while hi - lo > 1:
+            pixel_sizes[size] = (lo + hi) // 2
+            mfnc = trial()
+            if mfnc:
+                lo, best = pixel_sizes[size], mfnc
+            else:
+                hi = pixel_sizes[size]
+        pixel_sizes[size] = lo
+
+    if not best:
+        raise ValueError("Too many chars even at scale %.2f, try to trim the font size using filters" % min_scale)
+    print('Fitted pixel sizes: %s' % ', '.join('%d: %d' % i for i in pixel_sizes.items()))
+    return best
+
+
+def build_stamp_path(mtxt_path):
+    # Beside the atlas png, a build file that never goes into the romfs
+    return os.path.splitext(mtxt_path)[0] + '.build.json'
+
+
+def build_inputs(ttf_path, texture_size, specs, chars, gtbl_path_ingame=None, mtxt_path_ingame=None):
+    # Everything but the charset a build of chars depends on, saved in its build stamp.
+    # Filters only count for chars, so growing a filter along with the charset
+    # still allows an incremental build.
+    chars = set(c for c in chars if ord(c) not in ICONS)
+    fonts = {}
+    for size, filter, font_path, use_icon, priority in specs:
+        wanted = chars & set(filter) if filter else chars
+        fonts[str(size)] = {'ttf': file_digest(font_path or ttf_path),
+                            'filter': data_digest(''.join(sorted(wanted)).encode('utf-8')),
+                            'useicon': bool(use_icon)}
+    return {'texture_size': list(texture_size), 'glyph_table_ingame': gtbl_path_ingame,
+            'texture_ingame': mtxt_path_ingame, 'fonts': fonts}
+
+
+def save_build_stamp(stamp_path, inputs, pixel_sizes):
+    for size, pixel_size in pixel_sizes.items():
+        inputs['fonts'][str(size)]['pixel_size'] = pixel_size
+    save_json(stamp_path, inputs)
+
+
+def build_stamp_matches(stamp_path, inputs, autofit=False):
+    stamp = load_json(stamp_path)
+    if not stamp or set(stamp.get('fonts', {})) != set(inputs['fonts']) or \
+            any(stamp.get(k) != v for k, v in inputs.items() if k != 'fonts'):
+        return False
+    for size, font in inputs['fonts'].items():
+        old = dict(stamp['fonts'][size])
+        pixel_size = old.pop('pixel_size', None)
+        # Auto-fitted sizes are kept, others must still be the default one
+        if old != font or (not autofit and pixel_size != int(size) + 4):
+            return False
+    return True
+
+
+def patch_fonts(ttf_path, texture_size, specs, charset, gtbl_path, bfnt_path_fmt, mtxt_path,
+                gtbl_path_ingame=None, mtxt_path_ingame=None, workers=None, cache=None, autofit=False,
+                stamp_path=None):
+    # Adds the chars a previous build lacks like extend does, into the free space below
+    # its atlas content. Returns False when a full build is needed instead, e.g. when the
+    # TTFs, filters or icons differ from the ones the previous build was made with.
+    stamp_path = stamp_path or build_stamp_path(mtxt_path)
+    paths = [bfnt_path_fmt.format(spec[0]) for spec in specs]
+    if not all(os.path.isfile(p) for p in [gtbl_path] + paths):
+        return False
+
+    old_chars = set(chr(c) for c in CharTable(gtbl_path).entries.values())
+    inputs = build_inputs(ttf_path, texture_size, specs, old_chars, gtbl_path_ingame, mtxt_path_ingame)
+    if not build_stamp_matches(stamp_path, inputs, autofit):
+        print('Build inputs changed')
+        return False
+    new_chars = [c for c in sorted(charset) if c not in old_chars]
+    if not new_chars:
+        print('Fonts are up to date')
+        return True
+
+    mfnc = MetroidFontCollection.load(gtbl_path, bfnt_path_fmt, [spec[0] for spec in specs], mtxt_path, ttf_path)
+    base = mtxt_path_ingame or mtxt_path
+    if tuple(mfnc.texture_size) != tuple(texture_size) or any(
+            font.texture_name != page_path(base, font.page) or
+            font.glyph_table_name != (gtbl_path_ingame or gtbl_path) for font in mfnc.fonts.values()):
+        return False
+
+    mfnc.set_sources(specs)
+    mfnc.add_chars(new_chars, workers, cache=cache)
+    try:
+        mfnc.save(gtbl_path, bfnt_path_fmt, mtxt_path, gtbl_path_ingame, mtxt_path_ingame)
+    except AtlasOverflowError as e:
+        print(e)
+        return False
+
+    save_build_stamp(stamp_path, build_inputs(ttf_path, texture_size, specs, mfnc.chars,
+                                              gtbl_path_ingame, mtxt_path_ingame),
+                     {size: font.font_size for size, font in mfnc.fonts.items()})
+    print('Patched %d new chars' % len(new_chars))
+    return True
+
+
+def parse_specs(kwargs):
+    # Fonts are given as --<size> <filter> [--<size>-ttf <ttf>] [--<size>-useicon]
+    # [--<size>-priority <n>]
+    specs = []
+    for kw in kwargs:
+        if '_ttf' in kw or '_useicon' in kw or '_priority' in kw:
+            continue
+
+        size = int(kw)
+        filter = open(kwargs[kw], 'r', encoding='utf-16').read()
+        font_path = None
+        if kw+'_ttf' in kwargs:
+            font_path = kwargs[kw+'_ttf']
+        print('Add font size: %d, filter: %s' % (size, kwargs[kw]))
+        specs.append((size, filter, font_path, kw+'_useicon' in kwargs,
+                      int(kwargs.get(kw+'_priority', 0))))
+    return specs
+
+
 class Actions(object):
     @staticmethod
-    def create(ttf_path, charset_path, gtbl_path, bfnt_path_fmt, mtxt_path, mtxt_width, mtxt_height,
-               gtbl_path_ingame=None, mtxt_path_ingame=None, **kwargs):
-        mfnc = MetroidFontCollection.new(ttf_path, (mtxt_width, mtxt_height))
-        for kw in kwargs:
-            if '_ttf' in kw or '_useicon' in kw:
-                continue
+    def compile_icons(path=None):
+        compile_icons(path)
 
-            size = int(kw)
-            filter = open(kwargs[kw], 'r', encoding='utf-16').read()
-            font_path = None
-            if kw+'_ttf' in kwargs:
-                font_path = kwargs[kw+'_ttf']
-            print('Add font size: %d, filter: %s' % (size, kwargs[kw]))
-            mfnc.add_font(size, filter, font_path, kw+'_useicon' in kwargs)
+    @staticmethod
+    def extend(ttf_path, charset_path, gtbl_path, bfnt_path_fmt, mtxt_path, workers=None, **kwargs):
+        # Adds the chars of charset_path missing from existing fonts (e.g. the game's) in place,
+        # their glyphs are neither rasterized again nor moved. Fonts are given as in create,
+        # icons are kept as the fonts have them.
+        specs = parse_specs(kwargs)
+        mfnc = MetroidFontCollection.load(gtbl_path, bfnt_path_fmt, [spec[0] for spec in specs],
+                                          mtxt_path, ttf_path)
+        mfnc.set_sources(specs)
+        charset = set((c for c in open(charset_path, 'r', encoding='utf-16').read() if ord(c) not in ICONS))
+        mfnc.add_chars(charset, workers)
+        mfnc.save(gtbl_path, bfnt_path_fmt, mtxt_path)
+
+    @staticmethod
+    def create(ttf_path, charset_path, gtbl_path, bfnt_path_fmt, mtxt_path, mtxt_width, mtxt_height,
+               gtbl_path_ingame=None, mtxt_path_ingame=None, workers=None,
+               cache_path=None, cache_size=256, autofit=False, min_scale=0.5, max_pages=1,
+               incremental=False, stamp_path=None, **kwargs):
+        # With --autofit lower priorities are shrunk first.
+        # With --max-pages N fonts that don't fit go to <mtxt_path>_1, _2... pages.
+        # --incremental adds new chars to the previous outputs when they have room, the
+        # inputs of the last build are kept in --stamp-path (atlas.build.json beside atlas.png)
+        specs = parse_specs(kwargs)
 
-        i = 1
         charset = set((c for c in open(charset_path, 'r',
                       encoding='utf-16').read() if ord(c) not in ICONS))
-        for c in charset:
-            sys.stdout.write("Adding chars...(%d/%d)\r" % (i, len(charset)))
-            mfnc.add_char(c)
-            i += 1
-        print('')
+        cache = GlyphCache(cache_path, cache_size * 0x100000) if cache_path else None
+        try:
+            if incremental and patch_fonts(ttf_path, (mtxt_width, mtxt_height), specs, charset,
+                                           gtbl_path, bfnt_path_fmt, mtxt_path, gtbl_path_ingame,
+                                           mtxt_path_ingame, workers, cache, autofit, stamp_path):
+                return
+            if incremental:
+                print('Falling back to a full rebuild')
+            if autofit:
+                mfnc = fit_collection(ttf_path, (mtxt_width, mtxt_height), specs, charset,
+                                      min_scale, workers, cache, max_pages)
+            else:
+                mfnc = build_collection(ttf_path, (mtxt_width, mtxt_height), specs, charset,
+                                        workers=workers, cache=cache, max_pages=max_pages)
+            if cache:
+                print('Glyph cache: %d hits, %d misses' % (cache.hits, cache.misses))
+        finally:
+            if cache:
+                cache.close()
 
         mfnc.save(gtbl_path, bfnt_path_fmt, mtxt_path,
                   gtbl_path_ingame, mtxt_path_ingame)
+        save_build_stamp(stamp_path or build_stamp_path(mtxt_path),
+                         build_inputs(ttf_path, (mtxt_width, mtxt_height), specs, mfnc.chars,
+                                      gtbl_path_ingame, mtxt_path_ingame),
+                         {size: font.font_size for size, font in mfnc.fonts.items()})
 
 
 if __name__ == '__main__':
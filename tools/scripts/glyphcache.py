@@ -0,0 +1,104 @@
+import sqlite3
+import time
+
+from utils import file_digest
+
+
+class GlyphCache(object):
+    # Rendered glyphs keyed by (TTF content hash, pixel size, load flags, codepoint),
+    # least recently used ones are evicted once the bitmaps exceed max_size bytes
+    def __init__(self, path, max_size=256 * 0x100000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._hashes = {}
+        self.db = sqlite3.connect(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS glyphs (
+            font TEXT, size INTEGER, flags INTEGER, code INTEGER,
+            width INTEGER, rows INTEGER, data BLOB,
+            xoffset INTEGER, yoffset INTEGER, xadv INTEGER, used REAL,
+            PRIMARY KEY (font, size, flags, code))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS glyphs_used ON glyphs (used)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def font_hash(self, font_path):
+        if font_path not in self._hashes:
+            self._hashes[font_path] = file_digest(font_path)
+        return self._hashes[font_path]
+
+    def get(self, font_path, size, flags, chars):
+        # Returns {char: (width, rows, data, xoffset, yoffset, xadv)} for the cached chars
+        font = self.font_hash(font_path)
+        wanted = {ord(c): c for c in chars}
+        result = {}
+        for row in self.db.execute(
+                'SELECT code, width, rows, data, xoffset, yoffset, xadv FROM glyphs '
+                'WHERE font = ? AND size = ? AND flags = ?', (font, size, flags)):
+            if row[0] in wanted:
+                result[wanted[row[0]]] = row[1:]
+
+        now = time.time()
+        self.db.executemany('UPDATE glyphs SET used = ? WHERE font = ? AND size = ? AND flags = ? AND code = ?',
+                            ((now, font, size, flags, ord(c)) for c in result))
+        self.hits += len(result)
+        self.misses += len(wanted) - len(result)
+        return result
+
+    def put(self, font_path, size, flags, rasters):
+        font = self.font_hash(font_path)
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO glyphs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            ((font, size, flags, ord(c), r[0], r[1], r[2], r[3], r[4], r[5], now)
+                             for c, r in rasters.items()))
+
+    def evict(self):
+        total ,= self.db.execute('SELECT COALESCE(SUM(LENGTH(data)), 0) FROM glyphs').fetchone()
+        if total <= self.max_size:
+            return 0
+
+        stale = []
+        for rowid, size in self.db.execute('SELECT rowid, LENGTH(data) FROM glyphs ORDER BY used'):
+            if total <= self.max_size:
+                break
+            stale.append((rowid,))
+            total -= size or 0
+        self.db.executemany('DELETE FROM glyphs WHERE rowid = ?', stale)
+        return len(stale)
+
+    def close(self):
+        if self.db is not None:
+            self.evict()
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+
+class MemoryGlyphCache(object):
+    # Same interface as GlyphCache, keeps rasters in memory (e.g. between auto-fit
+    # trials) in front of an optional persistent cache
+    def __init__(self, backing=None):
+        self.backing = backing
+        self.glyphs = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, font_path, size, flags, chars):
+        glyphs = self.glyphs.setdefault((font_path, size, flags), {})
+        result = {c: glyphs[c] for c in chars if c in glyphs}
+        if self.backing:
+            found = self.backing.get(font_path, size, flags, [c for c in chars if c not in glyphs])
+            glyphs.update(found)
+            result.update(found)
+        self.hits += len(result)
+        self.misses += len(chars) - len(result)
+        return result
+
+    def put(self, font_path, size, flags, rasters):
+        self.glyphs.setdefault((font_path, size, flags), {}).update(rasters)
+        if self.backing:
+            self.backing.put(font_path, size, flags, rasters)
@@ -1,15 +1,90 @@
+import json
 import struct
+import sys
 import os
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import Image, ImageDraw, ImageFont
 
+# magic, version (4 bytes), texture path offset, texture width, height, unk1, unk2,
+# font size, glyph count, unk3, glyph data offset, glyph table path offset
+BFONT_HEADER = '4sBBBBqiihhiiiqq'
+GLYPH_FIELDS = ('x', 'y', 'width', 'height', 'attr1', 'attr2', 'attr3')
+GLYPH_RECORD_SIZE = 0x0E
+CHAR_RECORD_SIZE = 0x08
+
+
+def le_array(typecode, data=b''):
+    # Files are little endian, arrays are native
+    arr = array(typecode)
+    arr.frombytes(data)
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr
+
+
+def le_bytes(arr):
+    if sys.byteorder != 'little':
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+class GlyphTable(object):
+    # Every glyph record of a bfont in one flat array, 7 shorts per glyph.
+    # Indexing returns MFontEntry views onto the array.
+    def __init__(self, data=b''):
+        self.values = le_array('h', data)
+
+    def __len__(self):
+        return len(self.values) // len(GLYPH_FIELDS)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return MFontEntry(table=self, index=i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield MFontEntry(table=self, index=i)
+
+    def append(self, x, y, width, height, attr1, attr2, attr3):
+        self.values.extend((x, y, width, height, attr1, attr2, attr3))
+
+    def set(self, i, x, y, width, height, attr1, attr2, attr3):
+        k = i * len(GLYPH_FIELDS)
+        self.values[k:k + len(GLYPH_FIELDS)] = array('h', (x, y, width, height, attr1, attr2, attr3))
+
+    def pad(self, count):
+        self.values.extend([0] * (count * len(GLYPH_FIELDS)))
+
+    def column(self, field):
+        return self.values[GLYPH_FIELDS.index(field)::len(GLYPH_FIELDS)]
+
+    def tobytes(self):
+        return le_bytes(self.values)
+
+
+def glyph_field(k):
+    def get(self):
+        return self.table.values[self.index * len(GLYPH_FIELDS) + k]
+
+    def set(self, value):
+        self.table.values[self.index * len(GLYPH_FIELDS) + k] = value
+    return property(get, set)
+
 
 class MFontEntry(object):
-    def __init__(self, data):
-        (self.x, self.y,
-         self.width, self.height,
-         self.attr1, self.attr2, self.attr3) = struct.unpack('hhhhhhh', data)
-        self.bitmap = None
+    __slots__ = ('table', 'index')
+
+    def __init__(self, data=None, table=None, index=0):
+        self.table = table if table is not None else GlyphTable(data or bytes(GLYPH_RECORD_SIZE))
+        self.index = index
+
+    x, y, width, height, attr1, attr2, attr3 = [glyph_field(k) for k in range(len(GLYPH_FIELDS))]
 
     def __cmp__(self, other):
         return self.width.__cmp__(other.width)
@@ -36,9 +111,10 @@ class MFontEntry(object):
 
 class MFont(object):
     def __init__(self, path=None):
-        self.entries = []
+        self.entries = GlyphTable()
         self.image_width = 0
         self.image_height = 0
+        self.texture_path = ''
         if path:
             self.load(path)
         print("Font size:", self.font_size)
@@ -46,36 +122,82 @@ class MFont(object):
 
     def load(self, path):
         fs = open(path, 'rb')
-        (magic, version, header_size,
+        (magic, v0, v1, v2, v3, header_size,
          self.image_width, self.image_height,
-         unk1, self.font_size,
-         self.entry_count, ukn2, entry_offset, data_size) = struct.unpack('4siqiiiiiiqq',
-                                                                          fs.read(struct.calcsize('4siqiiiiiiqq')))
+         unk1, unk2, self.font_size,
+         self.entry_count, unk3, entry_offset, table_path_offset) = struct.unpack(
+            '<' + BFONT_HEADER, fs.read(struct.calcsize('<' + BFONT_HEADER)))
+
+        fs.seek(header_size, 0)
+        self.texture_path = fs.read(entry_offset - header_size).split(b'\x00')[0].decode('utf-8')
 
         fs.seek(entry_offset, 0)
-        self.entries = []
-        for i in range(self.entry_count):
-            self.entries.append(MFontEntry(fs.read(0x0E)))
+        self.entries = GlyphTable(fs.read(self.entry_count * GLYPH_RECORD_SIZE))
 
         fs.close()
 
-    def export_images(self, img_path, out_dir, char_table=None):
+    def export_images(self, img_path, out_dir, char_table=None, workers=8, verbose=False):
         img = Image.open(img_path)
+        img.load()
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
 
-        for i in range(len(self.entries)):
-            im = img.crop(self.entries[i].box)
-            path = '%d.png' % i
+        def save(i):
             if char_table:
+                if i not in char_table:
+                    return None
                 path = '%04x.png' % char_table[i]
+            else:
+                path = '%d.png' % i
             path = os.path.join(out_dir, path)
-            try:
-                if not os.path.exists(out_dir):
-                    os.makedirs(out_dir)
-                im.save(path)
-                print('Save:', path)
-            except:
-                print('')
+            img.crop(self.entries[i].box).save(path)
+            return path
+
+        # Rects with no pixels (ids a font has no glyph for) are skipped
+        ids = [i for i in range(len(self.entries)) if self.entries[i].width and self.entries[i].height]
+        saved, errors = 0, []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for i, future in zip(ids, [pool.submit(save, i) for i in ids]):
+                try:
+                    path = future.result()
+                except Exception as e:
+                    errors.append((i, e))
+                    continue
+                if path:
+                    saved += 1
+                    if verbose:
+                        print('Save:', path)
+
+        print('Saved %d glyphs to %s' % (saved, out_dir))
+        for i, e in errors:
+            print('Failed: glyph %d (%s)' % (i, e))
+        return saved, errors
+
+    def export_sheet(self, img_path, out_path, char_table=None, sheet_width=1024):
+        # All glyphs in id order on one sheet, with a JSON index next to it
+        img = Image.open(img_path)
+        img.load()
+
+        index = []
+        x = y = row_height = 0
+        for i, e in enumerate(self.entries):
+            if not e.width or not e.height:
                 continue
+            if x + e.width > sheet_width:
+                x, y, row_height = 0, y + row_height, 0
+            index.append({'id': i, 'char': char_table.get(i) if char_table else None,
+                          'x': x, 'y': y, 'width': e.width, 'height': e.height,
+                          'atlas': list(e.rect), 'attr': [e.attr1, e.attr2, e.attr3]})
+            x += e.width
+            row_height = max(row_height, e.height)
+
+        sheet = Image.new(img.mode, (sheet_width, max(y + row_height, 1)))
+        for item in index:
+            sheet.paste(img.crop(self.entries[item['id']].box), (item['x'], item['y']))
+        sheet.save(out_path)
+        with open(os.path.splitext(out_path)[0] + '.json', 'w', encoding='utf-8') as fs:
+            json.dump({'font_size': self.font_size, 'glyphs': index}, fs, indent=1)
+        print('Saved %d glyphs to %s' % (len(index), out_path))
 
     def render_chars(self, out_path, img_path):
         img = Image.open(img_path)
@@ -102,12 +224,15 @@ class CharTable(object):
         fs = open(path, 'rb')
         (magic, version, entries_cnt, _, tbl_offset) = struct.unpack(
             '4siiiq', fs.read(24))
-        fs.seek(tbl_offset, 0)
+        fs.seek(0, 0)
+        self.head = fs.read(tbl_offset)
+        self.data = fs.read(entries_cnt * CHAR_RECORD_SIZE)
+        fs.close()
 
-        self.entries = {}
-        for i in range(entries_cnt):
-            char, _, id = struct.unpack('Hhi', fs.read(8))
-            self.entries[id] = char
+        # Records are (u16 char, s16 -1, s32 id)
+        self.codes = le_array('H', self.data)[0::4]
+        self.ids = le_array('i', self.data)[1::2]
+        self.entries = dict(zip(self.ids, self.codes))
 
     @property
     def chars(self):
@@ -120,10 +245,14 @@ class Actions(object):
         MFont(mfnt).render_chars(png_out, png)
 
     @staticmethod
-    def export(mfnt_path, img_path, out_dir, char_table):
+    def export(mfnt_path, img_path, out_dir, char_table, workers=8, sheet=False, verbose=False):
+        # With --sheet, out_dir is the sprite sheet png and a .json index is written beside it
         char_table = CharTable(char_table)
         mfnt = MFont(mfnt_path)
-        mfnt.export_images(img_path, out_dir, char_table.entries)
+        if sheet:
+            mfnt.export_sheet(img_path, out_dir, char_table.entries)
+        else:
+            mfnt.export_images(img_path, out_dir, char_table.entries, workers, verbose)
 
     @staticmethod
     def dump_mapping(mfnt_path, buct_path):
@@ -0,0 +1,70 @@
+class AtlasOverflowError(ValueError):
+    pass
+
+
+class PackerItem(object):
+    __slots__ = ('x', 'y', 'width', 'height')
+
+    def __init__(self, width, height):
+        self.x = 0
+        self.y = 0
+        self.width = width
+        self.height = height
+
+    def __repr__(self):
+        return 'x: %d, y: %d, w: %d, h: %d' % (self.x, self.y, self.width, self.height)
+
+
+class ShelfPacker(object):
+    # First fit decreasing height: items are sorted by height and laid out left to
+    # right on shelves, so every earlier shelf is tall enough for the current item
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.shelves = []
+        self.open_shelves = []
+        self.bottom = 0
+        self.used_area = 0
+        self.items = []
+
+    @property
+    def fill(self):
+        return self.used_area / float(self.width * self.height)
+
+    def insert(self, item, min_width=1):
+        for shelf in self.open_shelves:
+            if self.width - shelf[2] >= item.width:
+                break
+        else:
+            if self.bottom + item.height > self.height:
+                return False
+            shelf = [self.bottom, item.height, 0]
+            self.shelves.append(shelf)
+            self.open_shelves.append(shelf)
+            self.bottom += item.height
+
+        item.x, item.y = shelf[2], shelf[0]
+        shelf[2] += item.width
+        if self.width - shelf[2] < min_width:
+            self.open_shelves.remove(shelf)
+        self.used_area += item.width * item.height
+        self.items.append(item)
+        return True
+
+    @staticmethod
+    def sort(items):
+        return sorted(items, key=lambda i: (-i.height, -i.width))
+
+    @staticmethod
+    def pack(items, width, height):
+        # Returns one ShelfPacker per bin needed to hold all items
+        items = ShelfPacker.sort(items)
+        min_width = min((i.width for i in items), default=1)
+        bins = [ShelfPacker(width, height)]
+        for item in items:
+            if item.width > width or item.height > height:
+                raise AtlasOverflowError("Item larger than the bin: %r" % item)
+            if not bins[-1].insert(item, min_width):
+                bins.append(ShelfPacker(width, height))
+                bins[-1].insert(item, min_width)
+        return bins
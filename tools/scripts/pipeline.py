@@ -0,0 +1,361 @@
+# coding: utf-8
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from btxt import BinaryText
+from charset import charset_path, parse_text, save_charsets, text_chars
+from font import Actions as FontActions, page_path
+from pkg import Package, extract_package
+from utils import BatchReport, data_digest, file_digest, load_json, mkdirs, save_json
+
+
+# Node actions, run in pool workers
+
+
+def convert_text(plain, dst, src=None):
+    # Plain text to binary text, imported over the original src when given
+    btxt = BinaryText()
+    if src:
+        btxt.load(src)
+        print('%s: %r' % (plain, btxt.import_text(plain)))
+    else:
+        btxt.from_text(plain)
+    mkdirs(os.path.dirname(dst))
+    btxt.save(dst)
+
+
+def repack_package(src, overlay, dst):
+    # Original package with the entries found in overlay replaced
+    mkdirs(os.path.dirname(dst))
+    with Package(src, lazy=True) as pkg:
+        pkg.import_data(overlay)
+        pkg.save(dst)
+
+
+def scan_charset(texts, out_dir, name, patterns):
+    groups = {group: set() for group in [''] + list(patterns)}
+    for path in texts:
+        with open(path, 'rb') as fs:
+            btxt = parse_text(fs.read())
+        for group, chars in text_chars(btxt, patterns).items():
+            groups[group].update(chars)
+    save_charsets({name: groups}, out_dir)
+
+
+def build_font(ttf_path, charset, sizes, gtbl_path, bfnt_path_fmt, mtxt_path, options):
+    # sizes is {size: {'filter': path, 'ttf': path, 'useicon': bool, 'priority': n}},
+    # options the other arguments of font.py create
+    kwargs = dict(options)
+    for size, spec in sizes.items():
+        kwargs[size] = spec.get('filter') or charset
+        if spec.get('ttf'):
+            kwargs[size + '_ttf'] = spec['ttf']
+        if spec.get('useicon'):
+            kwargs[size + '_useicon'] = True
+        if 'priority' in spec:
+            kwargs[size + '_priority'] = spec['priority']
+    for path in (gtbl_path, bfnt_path_fmt, mtxt_path):
+        mkdirs(os.path.dirname(path))
+    FontActions.create(ttf_path, charset, gtbl_path, bfnt_path_fmt, mtxt_path, **kwargs)
+
+
+def run_mtxttool(tool, mtxt_path, out_path, orig_path):
+    # Converts every atlas page of a font build into textures based on the original one
+    mkdirs(os.path.dirname(out_path))
+    page = 0
+    while os.path.isfile(page_path(mtxt_path, page).replace('.bctex', '.png')):
+        subprocess.run([tool, '-ig', page_path(mtxt_path, page).replace('.bctex', '.png'),
+                        '-t', page_path(out_path, page), orig_path], check=True)
+        page += 1
+
+
+class Node(object):
+    def __init__(self, name, func, args, inputs=(), outputs=()):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.inputs = [os.path.abspath(p) for p in inputs]
+        self.outputs = [os.path.abspath(p) for p in outputs]
+        self.deps = set()
+
+    def __repr__(self):
+        return self.name
+
+
+def inside(path, root):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+class Pipeline(object):
+    # Nodes run when the content of their inputs changed since their last run (or an
+    # output is missing), after every node producing one of their inputs
+    def __init__(self, stamp_path):
+        self.nodes = {}
+        self.stamp_path = stamp_path
+        self.stamps = load_json(stamp_path, None) or {'nodes': {}, 'files': {}}
+        self._seen = {}
+
+    def add(self, node):
+        if node.name in self.nodes:
+            raise ValueError("Duplicate node: %s" % node.name)
+        self.nodes[node.name] = node
+        return node
+
+    def link(self):
+        for node in self.nodes.values():
+            node.deps = set(other.name for other in self.nodes.values() if other is not node and any(
+                inside(i, o) or inside(o, i) for i in node.inputs for o in other.outputs))
+
+    def select(self, targets):
+        # Nodes whose name starts with one of targets, and everything they depend on
+        selected = set()
+        stack = [n for n in self.nodes if any(n.startswith(t) for t in targets)]
+        while stack:
+            name = stack.pop()
+            if name not in selected:
+                selected.add(name)
+                stack.extend(self.nodes[name].deps)
+        self.nodes = {k: v for k, v in self.nodes.items() if k in selected}
+
+    def file_digest(self, path):
+        st = os.stat(path)
+        old = self.stamps['files'].get(path)
+        if old and old[:2] == [st.st_size, st.st_mtime_ns]:
+            digest = old[2]
+        else:
+            digest = file_digest(path)
+        self._seen[path] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def digest(self, path):
+        if os.path.isfile(path):
+            return self.file_digest(path)
+        if not os.path.isdir(path):
+            return None
+        files = []
+        for parent, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                fp = os.path.join(parent, name)
+                files.append([os.path.relpath(fp, path), self.file_digest(fp)])
+        return data_digest(json.dumps(files).encode('utf-8'))
+
+    def key(self, node):
+        return data_digest(json.dumps([node.func.__name__, node.args, [self.digest(p) for p in node.inputs]],
+                                      sort_keys=True).encode('utf-8'))
+
+    def up_to_date(self, node, key):
+        return self.stamps['nodes'].get(node.name) == key and all(os.path.exists(p) for p in node.outputs)
+
+    def output_size(self, node):
+        size = 0
+        for path in node.outputs:
+            if os.path.isfile(path):
+                size += os.path.getsize(path)
+            for parent, dirnames, filenames in os.walk(path):
+                size += sum(os.path.getsize(os.path.join(parent, n)) for n in filenames)
+        return size
+
+    def save(self):
+        self.stamps['files'].update(self._seen)
+        mkdirs(os.path.dirname(self.stamp_path))
+        save_json(self.stamp_path, self.stamps)
+
+    def run(self, jobs=None, force=False, dry_run=False):
+        self.link()
+        report = BatchReport(len(self.nodes), 'outputs')
+        pending = list(self.nodes.values())
+        done, failed, running, changed = set(), set(), {}, set()
+        pool = ProcessPoolExecutor(max_workers=jobs) if jobs != 1 and not dry_run else None
+
+        def finish(node, key, start, error=None):
+            if error:
+                failed.add(node.name)
+                report.fail(node.name, error)
+                return
+            done.add(node.name)
+            self.stamps['nodes'][node.name] = key
+            self.save()
+            report.add(node.name, len(node.outputs), self.output_size(node), time.perf_counter() - start)
+
+        try:
+            while pending or running:
+                progress = False
+                for node in list(pending):
+                    if node.deps & failed:
+                        pending.remove(node)
+                        failed.add(node.name)
+                        report.fail(node.name, 'depends on %s' % ', '.join(sorted(node.deps & failed)))
+                        progress = True
+                        continue
+                    if not node.deps <= done:
+                        continue
+                    pending.remove(node)
+                    progress = True
+
+                    key = self.key(node)
+                    if not force and not node.deps & changed and self.up_to_date(node, key):
+                        done.add(node.name)
+                        report.skip(node.name)
+                    elif dry_run:
+                        # Nothing is built, so everything after a node that would run is listed too
+                        done.add(node.name)
+                        changed.add(node.name)
+                        print('Would run:', node.name)
+                    elif pool is None:
+                        start = time.perf_counter()
+                        try:
+                            node.func(*node.args)
+                        except Exception as e:
+                            finish(node, key, start, e)
+                        else:
+                            finish(node, key, start)
+                    else:
+                        running[pool.submit(node.func, *node.args)] = (node, key, time.perf_counter())
+
+                if running:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        node, key, start = running.pop(future)
+                        finish(node, key, start, future.exception())
+                elif pending and not progress:
+                    raise ValueError("Dependency cycle: %s" % ', '.join(n.name for n in pending))
+        finally:
+            if pool:
+                pool.shutdown()
+            if not dry_run:
+                self.save()
+        report.summary()
+        return not report.failed
+
+
+def split_package(path):
+    # 'packs/x.pkg/<entry>' -> ('packs/x.pkg', '<entry>'), loose files -> (None, path)
+    i = path.lower().find('.pkg/')
+    if i < 0:
+        return None, path
+    return path[:i + 4], path[i + 5:]
+
+
+def load_pipeline(config_path):
+    # Paths of the config are relative to it. See pipeline_example.json.
+    config = load_json(config_path)
+    if config is None:
+        raise ValueError("Cannot read config: %s" % config_path)
+    base = os.path.dirname(os.path.abspath(config_path))
+
+    def path(p):
+        return os.path.join(base, p) if p else p
+
+    romfs, output = path(config['romfs']), path(config['output'])
+    work = path(config.get('work', 'work'))
+    pipeline = Pipeline(os.path.join(work, 'pipeline.json'))
+
+    # Texts, package entries go through an overlay of changed entries that is imported
+    # over the original package
+    text_outputs = {}
+    packages = set()
+    for text in config.get('texts', []):
+        pkg, entry = split_package(text['binary'])
+        src = None
+        if pkg:
+            packages.add(pkg)
+            dst = os.path.join(work, 'overlay', pkg, entry)
+            if text.get('mode', 'import') == 'import':
+                src = os.path.join(work, 'extract', pkg, entry)
+        else:
+            dst = os.path.join(output, entry)
+            if text.get('mode', 'import') == 'import':
+                src = os.path.join(romfs, entry)
+        text_outputs[text['binary']] = dst
+        pipeline.add(Node('text:' + text['binary'], convert_text, (path(text['plain']), dst, src),
+                          [path(text['plain'])] + ([src] if src else []), [dst]))
+
+    for pkg in sorted(packages):
+        extract = os.path.join(work, 'extract', pkg)
+        pipeline.add(Node('extract:' + pkg, extract_package, (os.path.join(romfs, pkg), extract),
+                          [os.path.join(romfs, pkg)], [extract]))
+        overlay = os.path.join(work, 'overlay', pkg)
+        pipeline.add(Node('repack:' + pkg, repack_package, (os.path.join(romfs, pkg), overlay, os.path.join(output, pkg)),
+                          [os.path.join(romfs, pkg), overlay], [os.path.join(output, pkg)]))
+
+    charsets = {}
+    for name, cs in config.get('charsets', {}).items():
+        texts = [text_outputs.get(t) or path(t) for t in cs.get('texts', sorted(text_outputs))]
+        patterns = cs.get('patterns', {})
+        out_dir = os.path.join(work, 'charsets')
+        charsets[name] = (charset_path(out_dir, name, ''), {
+            size: charset_path(out_dir, name, size) for size in patterns})
+        pipeline.add(Node('charset:' + name, scan_charset, (texts, out_dir, name, patterns), texts,
+                          [charsets[name][0]] + list(charsets[name][1].values())))
+
+    for font in config.get('fonts', []):
+        name = font['name']
+        if font['charset'] in charsets:
+            charset, filters = charsets[font['charset']]
+        else:
+            charset, filters = path(font['charset']), {}
+
+        sizes = {}
+        for size, spec in font['sizes'].items():
+            sizes[size] = dict(spec, filter=path(spec.get('filter')) or filters.get(size),
+                               ttf=path(spec.get('ttf')))
+        mtxt_path = os.path.join(work, 'fonts', name, os.path.basename(font['texture']))
+        stamp_path = os.path.join(work, 'fonts', name, 'build.json')
+        gtbl_path = os.path.join(output, font['glyph_table'])
+        bfnt_path_fmt = os.path.join(output, font['bfont'])
+        options = {
+            'mtxt_width': font['texture_size'][0], 'mtxt_height': font['texture_size'][1],
+            'gtbl_path_ingame': font.get('glyph_table_ingame', font['glyph_table']),
+            'mtxt_path_ingame': font.get('texture_ingame', font['texture']),
+            'stamp_path': stamp_path,
+        }
+        options.update(font.get('options', {}))
+        inputs = [path(font['ttf']), charset] + [p for s in sizes.values() for p in (s['filter'], s['ttf']) if p]
+        pipeline.add(Node('font:' + name, build_font,
+                          (path(font['ttf']), charset, sizes, gtbl_path, bfnt_path_fmt, mtxt_path, options),
+                          inputs, [gtbl_path, mtxt_path.replace('.bctex', '.png'), stamp_path] +
+                          [bfnt_path_fmt.format(size) for size in sizes]))
+
+        if config.get('mtxttool'):
+            orig = os.path.join(romfs, font['texture'])
+            out = os.path.join(output, font['texture'])
+            pipeline.add(Node('texture:' + name, run_mtxttool,
+                              (path(config['mtxttool']), mtxt_path, out, orig),
+                              [mtxt_path.replace('.bctex', '.png'), orig], [out]))
+    return pipeline
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build pipeline: package extraction, texts, charsets, fonts and repacking.")
+    parser.add_argument('config', help='Set pipeline config (json).')
+    parser.add_argument('targets', help='Only build nodes starting with these names (and their inputs).',
+                        nargs='*')
+    parser.add_argument('-j', '--jobs', help='Set worker count.', type=int, default=None)
+    parser.add_argument('-f', '--force', help='Run every node even if its inputs did not change.',
+                        action='store_true', default=False)
+    parser.add_argument('-n', '--dry-run', help='Only list the nodes that would run.',
+                        action='store_true', default=False)
+    parser.add_argument('-g', '--graph', help='Print the nodes and their dependencies.',
+                        action='store_true', default=False)
+    options = parser.parse_args()
+
+    pipeline = load_pipeline(options.config)
+    pipeline.link()
+    if options.targets:
+        pipeline.select(options.targets)
+    if options.graph:
+        for node in pipeline.nodes.values():
+            print('%s <- %s' % (node.name, ', '.join(sorted(node.deps)) or '-'))
+        return
+    sys.exit(0 if pipeline.run(options.jobs, options.force, options.dry_run) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,64 @@
 import argparse
+import mmap
 import os
 import struct
+import sys
+import time
 from io import BytesIO
 
-from utils import align, mkdirs
+from utils import (BatchReport, align, copy_range, data_digest, file_digest,
+                   load_json, mkdirs, run_parallel, save_json)
 
 
 class PackageEntry(object):
     def __init__(self, data=None):
         self.Hash1, self.Hash2, self.DataStart, self.DataEnd = (0,0,0,0)
-        self.Data = ''
+        # (path, offset, size) of the entry bytes on disk, read on demand
+        self.Source = None
+        self._data = b''
         if data:
             self.Hash1, self.Hash2, self.DataStart, self.DataEnd = struct.unpack_from('IIii', data)
-    
+
+    @property
+    def Data(self):
+        if self._data is None:
+            path, offset, size = self.Source
+            with open(path, 'rb') as fs:
+                fs.seek(offset, 0)
+                self._data = fs.read(size)
+        return self._data
+
+    @Data.setter
+    def Data(self, value):
+        self._data = value
+        self.Source = None
+
+    @property
+    def Size(self):
+        if self._data is None:
+            return self.Source[2]
+        return len(self._data)
+
+    def set_source(self, path, offset=0, size=None):
+        if size is None:
+            size = os.path.getsize(path) - offset
+        self._data = None
+        self.Source = (path, offset, size)
+
+    def peek(self, size):
+        if self._data is not None:
+            return bytes(self._data[:size])
+        path, offset, total = self.Source
+        with open(path, 'rb') as fs:
+            fs.seek(offset, 0)
+            return fs.read(min(size, total))
+
     def guess_type(self):
-        if self.Data:
+        if self.Size:
+            head = self.peek(4)
             try:
-                t = self.Data[:4].decode('ascii')
-                if self.Data[:4] == b'\x1bLua':
+                t = head.decode('ascii')
+                if head == b'\x1bLua':
                     t = 'lc'
             except:
                 t = 'bin'
@@ -58,37 +99,84 @@ class Package(object):
         'muct': 0x4,
     }
     TAIL_ALIGN_TYPES = ['cut', 'lc', 'msad', 'msat', 'mscu', 'mtxt']
+    STORE_INDEX = '.store.json'
 
-    def __init__(self, path=None, verbose=False):
+    def __init__(self, path=None, verbose=False, lazy=False):
+        self.entries = []
+        self.Verbose = verbose
+        self.Lazy = lazy
+        self._file = None
+        self._map = None
+        self._view = None
         if path:
             self.load(path)
-        self.Verbose = verbose
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._view is not None:
+            for e in self.entries:
+                if isinstance(e._data, memoryview):
+                    e._data.release()
+                    e._data = None if e.Source else b''
+            self._view.release()
+            try:
+                self._map.close()
+            except BufferError:
+                # Slices of entry data are still alive, the map goes away with the last of them
+                pass
+            self._file.close()
+            self._view = self._map = self._file = None
     
+    @staticmethod
+    def list_files(path):
+        return [fp for fp in sorted(os.listdir(path))
+                if 'empty.txt' not in fp and fp != Package.STORE_INDEX]
+
+    @staticmethod
+    def list_inputs(path):
+        # (name, file path, content hash or None) for every entry of an extracted tree.
+        # Loose files win over entries that live in the shared store.
+        inputs = {fp: (fp, os.path.join(path, fp), None) for fp in Package.list_files(path)}
+        index = load_json(os.path.join(path, Package.STORE_INDEX))
+        if index:
+            store = os.path.join(path, index['store'])
+            for name, digest in index['entries'].items():
+                if name not in inputs:
+                    inputs[name] = (name, Package.blob_path(store, digest, name), digest)
+        return [inputs[k] for k in sorted(inputs)]
+
+    @staticmethod
+    def blob_path(store, digest, name):
+        return os.path.join(store, digest[:2], digest + os.path.splitext(name)[1])
+
     def create(self, path):
         self.entries = []
-        files = os.listdir(path)
-        for fp in files:
-            if 'empty.txt' in fp:
-                continue
+        for name, fp, digest in self.list_inputs(path):
             entry = PackageEntry()
-            offsetstr, hashstr1, hashstr2 = os.path.splitext(os.path.basename(fp))[0].split('_')
+            offsetstr, hashstr1, hashstr2 = os.path.splitext(name)[0].split('_')
             entry.Hash1 = int(hashstr1, 16)
             entry.Hash2 = int(hashstr2, 16)
-            fp = os.path.join(path, fp)
             if self.Verbose:
                 print('Load:', fp)
-            entry.Data = open(fp, 'rb').read()
+            entry.set_source(fp)
             self.entries.append(entry)
 
     def import_data(self, path):
+        inputs = {name: fp for name, fp, digest in self.list_inputs(path)}
         for i in range(len(self.entries)):
-            fp = os.path.join(path, self.entries[i].filename)
-            if os.path.isfile(fp):
+            fp = inputs.get(self.entries[i].filename)
+            if fp and os.path.isfile(fp):
                 if self.Verbose:
                     print('Load:', fp)
-                self.entries[i].Data = open(fp, 'rb').read()
+                self.entries[i].set_source(fp)
 
     def load(self, path):
+        self.close()
         fs = open(path, 'rb')
         head_size ,= struct.unpack('i', fs.read(4))
         head = BytesIO(fs.read(head_size))
@@ -96,15 +184,28 @@ class Package(object):
         data_size, entry_cnt = struct.unpack('ii', head.read(8))
         if data_size > os.path.getsize(path) - head_size:
             raise Exception("Data size error (%d)"%data_size)
-        
+
+        if self.Lazy:
+            # Entries become slices of the mapped file, pages are only read when touched
+            self._file = fs
+            self._map = mmap.mmap(fs.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+
         self.entries = []
         for i in range(entry_cnt):
             entry = PackageEntry(head.read(0x10))
-            fs.seek(entry.DataStart, 0)
-            entry.Data = fs.read(entry.DataEnd - entry.DataStart)
+            if self.Lazy:
+                entry.set_source(path, entry.DataStart, entry.DataEnd - entry.DataStart)
+                entry._data = self._view[entry.DataStart:entry.DataEnd]
+            else:
+                fs.seek(entry.DataStart, 0)
+                entry.Data = fs.read(entry.DataEnd - entry.DataStart)
             self.entries.append(entry)
+
+        if not self.Lazy:
+            fs.close()
     
-    def extract(self, path):
+    def extract(self, path, store=None, link=False):
         if not os.path.isdir(path) and not os.path.exists(path):
             os.makedirs(path)
         
@@ -113,44 +214,239 @@ class Package(object):
                 empty.write("This directory is empty.")
                 return
         
+        if store:
+            self.extract_to_store(path, store, link)
+            return
+
+        with SourceFiles() as sources:
+            for e in self.entries:
+                pathOut = os.path.join(path, e.filename)
+                with open(pathOut, 'wb', buffering=0) as fs:
+                    sources.write_entry(fs, e)
+                if self.Verbose:
+                    print('Extract:', pathOut)
+
+    def extract_to_store(self, path, store, link=False):
+        # One blob per unique content in store, the package directory only gets
+        # an index (or hardlinks, which share edits with every other package!)
+        index = {}
         for e in self.entries:
-            pathOut = os.path.join(path, e.filename)
-            open(pathOut, 'wb').write(e.Data)
+            name = e.filename
+            digest = data_digest(e.Data)
+            blob = self.blob_path(store, digest, name)
+            if not os.path.isfile(blob):
+                mkdirs(os.path.dirname(blob))
+                tmp = '%s.%d.tmp' % (blob, os.getpid())
+                with open(tmp, 'wb') as fs:
+                    fs.write(e.Data)
+                os.replace(tmp, blob)
+
+            pathOut = os.path.join(path, name)
+            if link:
+                try:
+                    if os.path.exists(pathOut):
+                        os.remove(pathOut)
+                    os.link(blob, pathOut)
+                    if self.Verbose:
+                        print('Link:', pathOut)
+                    continue
+                except OSError:
+                    pass
+            index[name] = digest
             if self.Verbose:
-                print('Extract:', pathOut)
-    
-    def save(self, path):
-        fs = open(path, 'wb')
+                print('Store:', blob)
 
-        head_size = 0
-        data_size = 0
-        fs.write(struct.pack('iii', head_size, data_size, len(self.entries)))
-        
-        fs.write(b'\x00' * 0x10 * len(self.entries))
+        if index:
+            try:
+                rel = os.path.relpath(store, path)
+            except ValueError:
+                rel = os.path.abspath(store)
+            save_json(os.path.join(path, self.STORE_INDEX), {'store': rel, 'entries': index})
+
+    def layout(self):
+        pos = 12 + 0x10 * len(self.entries)
         if len(self.entries) > 0:
-            fs.seek(align(fs.tell(), 0x80), 1)
-        head_size = fs.tell() - 4
+            pos += align(pos, 0x80)
+        head_size = pos - 4
 
         for e in self.entries:
             t = e.guess_type()
             if t in self.DATA_ALIGNMENTS:
-                fs.seek(align(fs.tell(), self.DATA_ALIGNMENTS[t]), 1)
-            
-            e.DataStart = fs.tell()
-            fs.write(e.Data)
-            e.DataEnd = fs.tell()
+                pos += align(pos, self.DATA_ALIGNMENTS[t])
+            e.DataStart = pos
+            pos += e.Size
+            e.DataEnd = pos
             if t in self.TAIL_ALIGN_TYPES:
-                fs.write(b'\x00'*align(fs.tell(), 4))
-        data_size = fs.tell() - head_size - 4
-        
-        fs.seek(0, 0)
-        fs.write(struct.pack('iii', head_size, data_size, len(self.entries)))
+                pos += align(pos, 4)
+        data_size = pos - head_size - 4
+        return head_size, data_size
+
+    def save(self, path):
+        # Writing over a file we still read from goes through a temporary file
+        inplace = os.path.exists(path) and any(
+            e.Source and os.path.samefile(e.Source[0], path) for e in self.entries)
+        out_path = path + '.tmp' if inplace else path
 
+        head_size, data_size = self.layout()
+        fs = open(out_path, 'wb', buffering=0)
+        head = BytesIO()
+        head.write(struct.pack('iii', head_size, data_size, len(self.entries)))
         for e in self.entries:
-            fs.write(struct.pack('IIii', e.Hash1, e.Hash2, e.DataStart, e.DataEnd))
+            head.write(struct.pack('IIii', e.Hash1, e.Hash2, e.DataStart, e.DataEnd))
+        fs.write(head.getvalue())
 
+        with SourceFiles() as sources:
+            for e in self.entries:
+                fs.seek(e.DataStart, 0)
+                sources.write_entry(fs, e)
+        fs.truncate(head_size + data_size + 4)
         fs.close()
 
+        if inplace:
+            self.close()
+            os.replace(out_path, path)
+        for e in self.entries:
+            if e.Source:
+                e.Source = (path, e.DataStart, e.DataEnd - e.DataStart)
+
+
+class Manifest(object):
+    # Sizes, mtimes and hashes of an extracted tree, kept beside it as <dir>.manifest
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = os.path.normpath(path) + '.manifest'
+        data = load_json(self.path, {})
+        if data.get('version') != self.VERSION:
+            data = {}
+        self.entries = data.get('entries', {})
+        self.output = data.get('output', {})
+
+    def scan(self, path):
+        # Re-hash only files whose size or mtime moved since the last scan
+        entries = {}
+        for name, fp, digest in Package.list_inputs(path):
+            st = os.stat(fp)
+            old = self.entries.get(name)
+            if digest:
+                pass
+            elif old and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+                digest = old[2]
+            else:
+                digest = file_digest(fp)
+            entries[name] = [st.st_size, st.st_mtime_ns, digest]
+
+        changed = ({k: v[2] for k, v in entries.items()} !=
+                   {k: v[2] for k, v in self.entries.items()})
+        self.entries = entries
+        return changed
+
+    def output_matches(self, pkg_path):
+        if not os.path.isfile(pkg_path):
+            return False
+        st = os.stat(pkg_path)
+        return self.output == {'path': os.path.abspath(pkg_path),
+                               'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+    def set_output(self, pkg_path):
+        st = os.stat(pkg_path)
+        self.output = {'path': os.path.abspath(pkg_path),
+                       'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+    def save(self):
+        save_json(self.path, {'version': self.VERSION,
+                              'entries': self.entries, 'output': self.output})
+
+
+class SourceFiles(object):
+    def __init__(self):
+        self.fds = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+    def write_entry(self, fs, entry):
+        if not entry.Source:
+            fs.write(entry.Data)
+            return
+        path, offset, size = entry.Source
+        if path not in self.fds:
+            self.fds[path] = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        copy_range(self.fds[path], fs.fileno(), offset, size)
+
+
+def extract_package(pkg_path, out_dir, verbose=False, store=None, link=False):
+    start = time.perf_counter()
+    with Package(pkg_path, verbose=verbose, lazy=True) as pkg:
+        pkg.extract(out_dir, store, link)
+        size = sum(e.Size for e in pkg.entries)
+        return len(pkg.entries), size, time.perf_counter() - start
+
+
+def create_package(in_dir, pkg_path, verbose=False, incremental=False):
+    start = time.perf_counter()
+    if incremental:
+        manifest = Manifest(in_dir)
+        changed = manifest.scan(in_dir)
+        if not changed and manifest.output_matches(pkg_path):
+            manifest.save()
+            return None
+
+    if os.path.dirname(pkg_path):
+        mkdirs(os.path.dirname(pkg_path))
+    pkg = Package(verbose=verbose)
+    pkg.create(in_dir)
+    pkg.save(pkg_path)
+    if incremental:
+        manifest.set_output(pkg_path)
+        manifest.save()
+    size = sum(e.Size for e in pkg.entries)
+    return len(pkg.entries), size, time.perf_counter() - start
+
+
+def find_packages(root, dirs=False):
+    # Relative paths of *.pkg files (or extracted *.pkg directories) under root
+    result = []
+    for parent, dirnames, filenames in os.walk(root):
+        names = dirnames if dirs else filenames
+        for name in names:
+            if name.lower().endswith('.pkg'):
+                result.append(os.path.relpath(os.path.join(parent, name), root))
+        if dirs:
+            dirnames[:] = [d for d in dirnames if not d.lower().endswith('.pkg')]
+    return sorted(result)
+
+
+def batch(romfs, work_dir, create=False, jobs=None, verbose=False, incremental=False,
+          store=None, link=False):
+    if create:
+        names = find_packages(work_dir, dirs=True)
+        tasks = [(os.path.join(work_dir, n), os.path.join(romfs, n), verbose, incremental)
+                 for n in names]
+        func = create_package
+    else:
+        names = find_packages(romfs)
+        tasks = [(os.path.join(romfs, n), os.path.join(work_dir, n), verbose, store, link)
+                 for n in names]
+        func = extract_package
+
+    report = BatchReport(len(tasks))
+    for task, result, error in run_parallel(func, tasks, jobs):
+        name = os.path.relpath(task[0], work_dir if create else romfs)
+        if error:
+            report.fail(name, error)
+        elif result is None:
+            report.skip(name)
+        else:
+            report.add(name, *result)
+    report.summary()
+    return not report.failed
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -162,19 +458,31 @@ def main():
                         action='store_true', default=False)
     parser.add_argument('-f', '--file', help="Set package file.")
     parser.add_argument('-d', '--dir', help='Set dir.')
+    parser.add_argument('-r', '--romfs', help='Batch mode: process every package under this romfs root.')
+    parser.add_argument('-j', '--jobs', help='Set worker count for batch mode.', type=int, default=None)
+    parser.add_argument('-i', '--incremental', help='Skip packages whose files did not change since the last create.',
+                        action='store_true', default=False)
+    parser.add_argument('-s', '--store', help='Extract entry contents once into this shared store.')
+    parser.add_argument('--link', help='Hardlink stored entries into the package directory instead of indexing them.',
+                        action='store_true', default=False)
     parser.add_argument('-m', '--mkdir', help='Make directory for output.', action='store_true', default=False)
+    parser.add_argument('-l', '--lazy', help='Map the package instead of reading it into memory.',
+                        action='store_true', default=False)
     parser.add_argument('-v', '--verbose', help='Set verbose.', action='store_true', default=False)
     options = parser.parse_args()
 
-    if options.create:
+    if options.romfs:
+        ok = batch(options.romfs, options.dir, options.create, options.jobs,
+                   options.verbose, options.incremental, options.store, options.link)
+        sys.exit(0 if ok else 1)
+    elif options.create:
         if options.mkdir:
             mkdirs(os.path.split(options.file)[0])
-        pkg = Package(verbose=options.verbose)
-        pkg.create(options.dir)
-        pkg.save(options.file)
+        if create_package(options.dir, options.file, options.verbose, options.incremental) is None:
+            print('Unchanged:', options.file)
     elif options.extract:
-        pkg = Package(options.file, verbose=options.verbose)
-        pkg.extract(options.dir)
+        with Package(options.file, verbose=options.verbose, lazy=options.lazy) as pkg:
+            pkg.extract(options.dir, options.store, options.link)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,146 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import namedtuple
+
+from pkg import Package, find_packages
+from utils import run_parallel
+
+IndexEntry = namedtuple('IndexEntry', 'package start end type')
+
+
+def scan_package(romfs, name):
+    # Only the header and the first bytes of each entry (for the type) are touched
+    with Package(os.path.join(romfs, name), lazy=True) as pkg:
+        return [(e.Hash1, e.Hash2, e.DataStart, e.DataEnd,
+                 (e.guess_type() or '').encode('ascii')[:4]) for e in pkg.entries]
+
+
+class PackageIndex(object):
+    Magic = b'PIDX'
+    Version = 1
+    HEADER = struct.Struct('<4sIII')
+    RECORD = struct.Struct('<IIIii4s')
+
+    def __init__(self, path=None):
+        self.root = ''
+        self.packages = []
+        self.records = []
+        self._buf = None
+        self._base = 0
+        self._count = 0
+        if path:
+            self.load(path)
+
+    def build(self, romfs, jobs=None):
+        self.root = os.path.abspath(romfs)
+        self.packages = find_packages(romfs)
+        ids = {name: i for i, name in enumerate(self.packages)}
+        self.records = []
+        for (root, name), result, error in run_parallel(
+                scan_package, [(romfs, n) for n in self.packages], jobs):
+            if error:
+                print('Failed: %s (%s)' % (name, error))
+                continue
+            pid = ids[name]
+            self.records.extend((h1, h2, pid, start, end, t) for h1, h2, start, end, t in result)
+        self.records.sort()
+
+    def save(self, path):
+        with open(path, 'wb') as fs:
+            fs.write(self.HEADER.pack(self.Magic, self.Version, len(self.packages), len(self.records)))
+            for s in [self.root] + self.packages:
+                b = s.encode('utf-8')
+                fs.write(struct.pack('<H', len(b)) + b)
+            for r in self.records:
+                fs.write(self.RECORD.pack(*r))
+
+    def load(self, path):
+        with open(path, 'rb') as fs:
+            self._buf = mmap.mmap(fs.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, pkg_cnt, self._count = self.HEADER.unpack_from(self._buf, 0)
+        if magic != self.Magic or version != self.Version:
+            raise ValueError("Not a package index: %s" % path)
+
+        pos = self.HEADER.size
+        strings = []
+        for i in range(pkg_cnt + 1):
+            size ,= struct.unpack_from('<H', self._buf, pos)
+            strings.append(self._buf[pos + 2:pos + 2 + size].decode('utf-8'))
+            pos += 2 + size
+        self.root, self.packages = strings[0], strings[1:]
+        self._base = pos
+
+    def __len__(self):
+        return self._count if self._buf is not None else len(self.records)
+
+    def _record(self, i):
+        if self._buf is not None:
+            return self.RECORD.unpack_from(self._buf, self._base + i * self.RECORD.size)
+        return self.records[i]
+
+    def lookup(self, hash1, hash2=None):
+        key = (hash1, 0 if hash2 is None else hash2)
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[:2] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        result = []
+        for i in range(lo, len(self)):
+            h1, h2, pid, start, end, t = self._record(i)
+            if h1 != hash1 or (hash2 is not None and h2 != hash2):
+                break
+            result.append(IndexEntry(self.packages[pid], start, end, t.rstrip(b'\x00').decode('ascii')))
+        return result
+
+    def read(self, entry, romfs=None):
+        with open(os.path.join(romfs or self.root, entry.package), 'rb') as fs:
+            fs.seek(entry.start, 0)
+            return fs.read(entry.end - entry.start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Cross-package entry index tool.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-b', '--build', help='Build the index from every package under --romfs.',
+                       action='store_true', default=False)
+    group.add_argument('-q', '--query', help='Look up an entry by Hash1 [Hash2] (hex).', nargs='+')
+    parser.add_argument('-i', '--index', help='Set index file.', required=True)
+    parser.add_argument('-r', '--romfs', help='Set romfs root.')
+    parser.add_argument('-j', '--jobs', help='Set worker count for building.', type=int, default=None)
+    parser.add_argument('-o', '--output', help='Write the data of the first match to this file.')
+    options = parser.parse_args()
+
+    if options.build:
+        start = time.perf_counter()
+        index = PackageIndex()
+        index.build(options.romfs, options.jobs)
+        index.save(options.index)
+        print('Indexed %d entries in %d packages (%.2fs)' % (
+            len(index), len(index.packages), time.perf_counter() - start))
+    else:
+        index = PackageIndex(options.index)
+        hashes = [int(h, 16) for h in options.query]
+        start = time.perf_counter()
+        result = index.lookup(*hashes[:2])
+        elapsed = time.perf_counter() - start
+        for e in result:
+            print('%s 0x%08x 0x%08x %s' % (e.package, e.start, e.end, e.type))
+        print('%d match(es) in %.3fms' % (len(result), elapsed * 1000))
+        if result and options.output:
+            with open(options.output, 'wb') as fs:
+                fs.write(index.read(result[0], options.romfs))
+        if not result:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+# The scripts import each other as top level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def ttf_path():
+    from bench import find_font
+    path = os.environ.get('TEST_TTF') or find_font('A')
+    if not path:
+        pytest.skip('No TTF font found, set TEST_TTF')
+    return path
@@ -0,0 +1,54 @@
+import pytest
+
+import font
+from font import (ICONS, build_collection, build_inputs, build_stamp_matches, fit_collection, load_icons,
+                  save_build_stamp)
+from packer import AtlasOverflowError
+
+
+def test_autofit_shrinks_single_oversized_font(ttf_path):
+    # At its default pixel size this font alone overflows the page
+    chars = [chr(c) for c in range(0x21, 0x17f)]
+    mfnc = fit_collection(ttf_path, (512, 512), [(60, '', None, False, 0)], chars, workers=1)
+    assert mfnc.fonts[60].font_size < 64
+    assert len(mfnc.pack()) == 1
+
+
+
+def test_overflow_names_the_font_size(ttf_path):
+    chars = [chr(c) for c in range(0x21, 0x17f)]
+    mfnc = build_collection(ttf_path, (512, 512), [(60, '', None, False, 0)], chars, workers=1)
+    with pytest.raises(AtlasOverflowError, match=r'Font size 60 \(64px\)'):
+        mfnc.pack()
+
+def test_build_stamp_detects_changed_inputs(tmp_path, ttf_path):
+    stamp = str(tmp_path / 'atlas.build.json')
+    other = tmp_path / 'other.ttf'
+    other.write_bytes(open(ttf_path, 'rb').read() + b'\0')
+    chars = set('abc')
+    specs = [(20, 'ab', None, True, 0), (32, '', None, False, 0)]
+    save_build_stamp(stamp, build_inputs(ttf_path, (256, 256), specs, chars), {20: 24, 32: 36})
+
+    assert build_stamp_matches(stamp, build_inputs(ttf_path, (256, 256), specs, chars))
+    # A filter growing with the charset only matters for the chars already built
+    assert build_stamp_matches(stamp, build_inputs(ttf_path, (256, 256), [(20, 'abx', None, True, 0)] + specs[1:], chars))
+    assert not build_stamp_matches(stamp, build_inputs(ttf_path, (256, 256), [(20, 'a', None, True, 0)] + specs[1:], chars))
+    assert not build_stamp_matches(stamp, build_inputs(ttf_path, (256, 256), [(20, 'ab', None, False, 0)] + specs[1:], chars))
+    assert not build_stamp_matches(stamp, build_inputs(ttf_path, (256, 256), specs[:1] + [(32, '', str(other), False, 0)], chars))
+    assert not build_stamp_matches(stamp, build_inputs(ttf_path, (512, 256), specs, chars))
+    assert not build_stamp_matches(stamp, build_inputs(ttf_path, (256, 256), specs, chars, 'new/g.buct'))
+    assert not build_stamp_matches(stamp, build_inputs(ttf_path, (256, 256), specs, chars, None, 'new/atlas.bctex'))
+
+
+def test_bad_icon_bundle_is_rebuilt(tmp_path, monkeypatch):
+    bundle = str(tmp_path / 'icons.bin')
+    font.compile_icons(bundle)
+    data = open(bundle, 'rb').read()
+    with open(bundle, 'wb') as fs:
+        fs.write(data[:len(data) // 2])
+    monkeypatch.setattr(font, 'ICON_BUNDLE', bundle)
+    monkeypatch.setattr(font, '_icons', None)
+
+    assert len(load_icons()) == len(ICONS)
+    assert open(bundle, 'rb').read() == data
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['icons.bin']
@@ -0,0 +1,40 @@
+from utils import read_messages
+
+RULE = '－' * 20
+END = '＝' * 20
+
+
+def block(no, label, text):
+    return 'No.%d\nLabel: %s\n%s\n%s\n%s\n%s\n%s\n\n' % (no, label, RULE, text, RULE, text, END)
+
+
+def parse(tmp_path, text):
+    path = str(tmp_path / 'messages.txt')
+    with open(path, 'w', encoding='utf-16') as fs:
+        fs.write(text)
+    errors = []
+    return read_messages(path, errors), errors
+
+
+def test_valid_blocks(tmp_path):
+    messages, errors = parse(tmp_path, block(0, 'A', 'a\n\nb') + block(1, 'B', '＝＝'))
+    assert messages == [('A', 'a\n\nb'), ('B', '＝＝')]
+    assert errors == []
+
+
+def test_missing_end_rule_swallows_next_block(tmp_path):
+    # As with the old regex parser, the text only ends at a ＝ rule followed by a blank line
+    text = block(0, 'A', 'a').replace(END + '\n', '') + block(1, 'B', 'b')
+    messages, errors = parse(tmp_path, text)
+    assert messages == [('A', 'a\n\n' + block(1, 'B', 'b')[:-len(END) - 3])]
+    assert errors == []
+
+
+def test_head_at_end_of_label_line(tmp_path):
+    # The old regex found "No.<n>" at the end of any line, so it read this as block B
+    # with its head merged into the label line before. A line read as a label is not
+    # looked at again, so block B is dropped with an error now.
+    text = 'No.0\nLabel: No.5\n' + block(1, 'B', 'b').split('\n', 1)[1] + block(2, 'C', 'c')
+    messages, errors = parse(tmp_path, text)
+    assert messages == [('C', 'c')]
+    assert errors == [(1, 'missing separator after label')]
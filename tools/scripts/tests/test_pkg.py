@@ -0,0 +1,32 @@
+from pkg import Package, PackageEntry
+
+
+def make_package(path, count=3):
+    pkg = Package()
+    for i in range(count):
+        e = PackageEntry()
+        e.Hash1 = i
+        e.Data = b'MTXT' + bytes([i]) * 60
+        pkg.entries.append(e)
+    pkg.save(path)
+
+
+def test_close_with_live_slices(tmp_path):
+    path = str(tmp_path / 'a.pkg')
+    make_package(path)
+    with Package(path, lazy=True) as pkg:
+        head = pkg.entries[1].Data[:5]
+    assert bytes(head) == b'MTXT\x01'
+    assert pkg._map is None and pkg._file is None
+    assert pkg.entries[1].Data[:5] == b'MTXT\x01'
+
+
+def test_save_in_place_with_live_slices(tmp_path):
+    path = str(tmp_path / 'a.pkg')
+    make_package(path)
+    pkg = Package(path, lazy=True)
+    head = pkg.entries[2].Data[:5]
+    pkg.entries[0].Data = b'BTXT'
+    pkg.save(path)
+    assert bytes(head) == b'MTXT\x02'
+    assert [e.Data[:5] for e in Package(path).entries] == [b'BTXT', b'MTXT\x01', b'MTXT\x02']
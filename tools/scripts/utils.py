@@ -1,39 +1,217 @@
 # coding: utf-8
 import codecs
+import hashlib
+import json
 import os
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 def align(value, alignment):
     return (-value % alignment + alignment) % alignment
 
 
+COPY_CHUNK = 0x100000
+
+
+def copy_range(src_fd, dst_fd, offset, size):
+    # Copy size bytes at offset of src_fd to the current position of dst_fd
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while size > 0:
+                n = os.copy_file_range(src_fd, dst_fd, size, offset)
+                if n == 0:
+                    break
+                offset += n
+                size -= n
+        except OSError:
+            pass
+
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    while size > 0:
+        chunk = os.read(src_fd, min(size, COPY_CHUNK))
+        if not chunk:
+            raise IOError("Unexpected end of file (%d bytes left)" % size)
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        size -= len(chunk)
+
+
+def data_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_digest(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fs:
+        while True:
+            chunk = fs.read(COPY_CHUNK)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_json(path, default=None):
+    try:
+        with open(path, 'r', encoding='utf-8') as fs:
+            return json.load(fs)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, obj):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as fs:
+        json.dump(obj, fs, sort_keys=True)
+    os.replace(tmp, path)
+
+
 def mkdirs(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
 
-def readstrzt(stream):
-    result = ''
-    while True:
-        c = stream.read(1)
-        if c == '\0' or not c:
-            break
-        result += c
-    return result
+def run_parallel(func, tasks, workers=None):
+    # Yields (task, result, error) for func(*task) in completion order
+    if workers == 1:
+        for task in tasks:
+            try:
+                yield task, func(*task), None
+            except Exception as e:
+                yield task, None, e
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(func, *task): task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+
+class BatchReport(object):
+    def __init__(self, total, unit='entries'):
+        self.total = total
+        self.unit = unit
+        self.done = 0
+        self.skipped = 0
+        self.items = 0
+        self.size = 0
+        self.failed = []
+        self.start = time.perf_counter()
+
+    def add(self, name, items, size, seconds):
+        self.done += 1
+        self.items += items
+        self.size += size
+        print('[%d/%d] %s: %d %s, %.2f MB (%.2fs)' % (
+            self.done, self.total, name, items, self.unit, size / 0x100000, seconds))
+
+    def skip(self, name):
+        self.done += 1
+        self.skipped += 1
+        print('[%d/%d] %s: unchanged' % (self.done, self.total, name))
+
+    def fail(self, name, error):
+        self.done += 1
+        self.failed.append(name)
+        print('[%d/%d] %s: FAILED (%s)' % (self.done, self.total, name, error))
+
+    def summary(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        print('Done: %d ok, %d unchanged, %d failed, %d %s, %.2f MB in %.2fs (%.1f %s/s, %.2f MB/s)' % (
+            self.done - self.skipped - len(self.failed), self.skipped, len(self.failed), self.items, self.unit,
+            self.size / 0x100000, elapsed, self.items / elapsed, self.unit,
+            self.size / 0x100000 / elapsed))
+        for name in self.failed:
+            print('Failed:', name)
+
+
+def find_strzt(buf, start, width=1):
+    # Offset of the NUL terminator of the string at start (width-aligned), or len(buf)
+    term = b'\0' * width
+    pos = buf.find(term, start)
+    while pos >= 0 and (pos - start) % width:
+        pos = buf.find(term, pos + 1)
+    return len(buf) if pos < 0 else pos
+
+
+MESSAGE_HEAD = re.compile(r'No\.\d+$')
+
+
+def is_rule(line, c):
+    return line != '' and line.strip(c) == ''
+
+
+def iter_messages(path, errors=None):
+    # Streams (label, text) out of a file written with BinaryText.EXPORT_FMT.
+    # Malformed blocks are skipped and reported to errors as (line number, reason).
+    # Unlike the old regex, "No.<n>" ending a label line does not start a block.
+    def report(lineno, reason):
+        if errors is not None:
+            errors.append((lineno, reason))
+
+    state = 'head'
+    start = 0
+    label = None
+    lines = []
+    with open(path, 'r', encoding='utf-16') as fs:
+        for lineno, line in enumerate(fs, 1):
+            if line.endswith('\n'):
+                line = line[:-1]
 
+            if state == 'label':
+                if line.startswith('Label: ') and len(line) > 7:
+                    label = line[7:]
+                    state = 'rule'
+                    continue
+                report(start, 'missing "Label: " line')
+                state = 'head'
+            elif state == 'rule':
+                if is_rule(line, '－'):
+                    lines = []
+                    state = 'original'
+                    continue
+                report(start, 'missing separator after label')
+                state = 'head'
 
-def read_messages(path):
-    pat = re.compile(
-        "No\.\d+?\nLabel: .+?\n－+?\n[\s|\S]*?\n－+?\n[\s|\S]*?\n＝+?\n\n")
+            if state == 'head':
+                if MESSAGE_HEAD.search(line):
+                    start = lineno
+                    state = 'label'
+            elif state == 'original':
+                # The line after a separator always belongs to the text
+                if lines and is_rule(line, '－'):
+                    lines = []
+                    state = 'text'
+                else:
+                    lines.append(None)
+            elif state == 'text':
+                if lines and is_rule(line, '＝'):
+                    rule = line
+                    state = 'close'
+                else:
+                    lines.append(line)
+            elif state == 'close':
+                if line == '':
+                    yield label, '\n'.join(lines)
+                    state = 'head'
+                    continue
+                report(lineno - 1, 'separator not followed by a blank line')
+                lines.append(rule)
+                if is_rule(line, '＝'):
+                    rule = line
+                else:
+                    lines.append(line)
+                    state = 'text'
 
-    t = open(path, 'r', encoding='utf-16').read()
-    blocks = pat.findall(t)
+    if state != 'head':
+        report(start, 'unexpected end of file')
 
-    entries = []
-    for b in blocks:
-        m = re.match(
-            "No\.\d+?\nLabel: (.+?)\n－+?\n[\s|\S]*?\n－+?\n([\s|\S]*?)\n＝+?\n\n", b)
-        entries.append((m.group(1), m.group(2)))
 
-    return entries
+def read_messages(path, errors=None):
+    return list(iter_messages(path, errors))